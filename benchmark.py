@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import json
+import os
+import re
+import shutil
+import tempfile
+import time
+import tracemalloc
+import zlib
+import numpy as np
+from ebooklib import epub
+import ebooklib
+import book
+import embedding
+from book import Book
+from match import PageMatcher, Aligner, AlignMode, TEMP_SAVE_DIR
+from settings import *
+
+# 合成电子书与临时文件保存的位置
+BENCHMARK_DIR = os.path.join(TEMP_SAVE_DIR, 'benchmark')
+# 默认的基准结果文件
+BENCHMARK_BASELINE = 'benchmark_baseline.json'
+# 耗时超过基准结果的比例，超过则视为性能退化
+BENCHMARK_TOLERANCE = 0.2
+# 耗时增加少于该值(s)时视为误差
+BENCHMARK_MIN_DELTA = 0.05
+# 假向量模型的维度
+STUB_EMBEDDING_DIM = 256
+
+STAGES = ['parse', 'translate', 'match', 'align', 'save_combined']
+
+
+class StubEncoder:
+    """
+    离线测试用的向量模型，把英文单词与单个汉字哈希到固定维度的向量上，结果只由文本决定
+    """
+    token_pattern = re.compile(r'[\u4e00-\u9fff]|[A-Za-z0-9]+')
+
+    def __init__(self, dim=STUB_EMBEDDING_DIM):
+        self.dim = dim
+
+    def encode(self, texts, batch_size=None):
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for i, text in enumerate(texts):
+            for token in self.token_pattern.findall(text.lower()):
+                h = zlib.crc32(token.encode('utf-8'))
+                vectors[i, h % self.dim] += 1 if h & 0x80000000 else -1
+        return vectors
+
+
+class StubSimilarity:
+    """
+    与 text2vec.Similarity 接口相同的假模型
+    """
+
+    def __init__(self):
+        self.model = StubEncoder()
+
+    def get_score(self, sentence1, sentence2):
+        vectors = embedding.normalize(self.model.encode([sentence1, sentence2]))
+        return float(vectors[0] @ vectors[1])
+
+
+def install_stubs(cache_dir):
+    """
+    替换翻译器、向量模型与向量缓存，保证测试可以离线运行且结果可复现
+    :param cache_dir: 向量缓存位置，不与真实模型的缓存混用
+    :return: 恢复原来的翻译器、向量模型与向量缓存的函数
+    """
+    saved = book.translator, embedding.sim_model, embedding.vector_cache
+    book.set_translator('ECHO', cache=False)
+    embedding.sim_model = StubSimilarity()
+    embedding.vector_cache = embedding.VectorCache('benchmark-stub', cache_dir=cache_dir)
+
+    def restore():
+        with book.translator_lock:
+            book.translator = saved[0]
+        embedding.sim_model, embedding.vector_cache = saved[1], saved[2]
+
+    return restore
+
+
+def make_scaled_book(filename, scale, out_dir=BENCHMARK_DIR):
+    """
+    把一本书的所有章节复制scale份，生成一本更大的电子书
+    :param filename: epubs文件夹内的电子书
+    :param scale: 复制的份数
+    :param out_dir: 保存的位置
+    :return: 绝对路径，可直接传给Book
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    path = os.path.join(out_dir, '%s_x%d.epub' % (filename.split('.epub')[0], scale))
+    if not os.path.exists(path):
+        source = epub.read_epub(os.path.join(EPUB_DIR, filename))
+        documents = [_ for _ in source.get_items_of_type(ebooklib.ITEM_DOCUMENT) if 'nav' not in _.get_name()]
+        for k in range(1, scale):
+            for item in documents:
+                root, ext = os.path.splitext(item.file_name)
+                copy = epub.EpubHtml(uid='%s_x%d' % (item.id, k), file_name='%s_x%d%s' % (root, k, ext),
+                                     content=item.content)
+                source.add_item(copy)
+                source.spine.append(copy)
+        epub.write_epub(path, source)
+    return os.path.abspath(path)
+
+
+def run_pipeline(filename_left, filename_right, align_mode=AlignMode.WINDOW, workers=1, trace_memory=False):
+    """
+    运行一次完整流程：解析、翻译、章节匹配、段落对齐、合并输出，分别计时
+    :param filename_left: 英文版
+    :param filename_right: 中文版
+    :param align_mode: 段落对齐算法
+    :param workers: 解析章节使用的进程数量
+    :param trace_memory: 是否记录每个阶段的内存峰值
+    :return: {阶段: (耗时, 段落数, 章节数, 内存峰值MB)}
+    """
+    work_dir = tempfile.mkdtemp(dir=BENCHMARK_DIR)
+    restore = install_stubs(os.path.join(work_dir, 'embeddings'))
+    result = {}
+    state = {}
+
+    def measure(stage, func):
+        if trace_memory:
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        paragraphs, chapters = func()
+        cost = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1] / 2 ** 20 if trace_memory else None
+        result[stage] = (cost, paragraphs, chapters, peak)
+
+    def parse():
+        state['left'] = Book(filename_left, save=False, workers=workers)
+        state['right'] = Book(filename_right, save=False, workers=workers)
+        pages = state['left'].pages + state['right'].pages
+        return sum(len(_.paragraphs) for _ in pages), len(pages)
+
+    def translate():
+        state['left'].get_translate()
+        pages = state['left'].pages
+        return sum(p.is_translated for page in pages for p in page.paragraphs), len(pages)
+
+    def match():
+        matcher = PageMatcher(state['left'], state['right'])
+        matcher.filename = os.path.join(os.path.abspath(work_dir), 'pipeline.match')
+        matcher.match()
+        state['matched'] = matcher.matched_pages
+        return sum(len(_.paragraphs) for _ in state['left'].pages), len(state['left'].pages)
+
+    def align():
+        aligner = Aligner(mode=align_mode)
+        for page_left, page_right, _ in state['matched']:
+            aligner.align(page_left, page_right)
+        state['aligned'] = sum(1 for _ in state['matched'] for p in _[0].paragraphs if p.subjects)
+        return sum(len(_[0].paragraphs) for _ in state['matched']), len(state['matched'])
+
+    def save_combined():
+        state['left'].save_combined(os.path.join(work_dir, 'combined.epub'))
+        return sum(len(_.paragraphs) for _ in state['left'].pages), len(state['left'].pages)
+
+    try:
+        for stage, func in zip(STAGES, [parse, translate, match, align, save_combined]):
+            measure(stage, func)
+        # 假模型匹配不上章节时，对齐与合并阶段只是在空转，测得的吞吐量没有意义
+        if len(state['matched']) == 0 or state['aligned'] == 0:
+            raise RuntimeError("%s - %s 匹配到 %d 个章节，对齐了 %d 个段落，对齐与合并阶段没有实际工作"
+                               % (filename_left, filename_right, len(state['matched']), state['aligned']))
+    finally:
+        restore()
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return result
+
+
+def benchmark_pipeline(filename_left, filename_right, repeat=3, align_mode=AlignMode.WINDOW, workers=1):
+    """
+    重复运行完整流程，每个阶段取最短耗时计算吞吐量，另外单独运行一次记录内存峰值
+    :return: {阶段: {seconds, paragraphs_per_sec, chapters_per_sec, peak_mb}}
+    """
+    runs = [run_pipeline(filename_left, filename_right, align_mode, workers) for _ in range(repeat)]
+    tracemalloc.start()
+    try:
+        memory = run_pipeline(filename_left, filename_right, align_mode, workers, trace_memory=True)
+    finally:
+        tracemalloc.stop()
+    result = {}
+    for stage in STAGES:
+        cost, paragraphs, chapters, _ = min((_[stage] for _ in runs), key=lambda x: x[0])
+        result[stage] = {
+            'seconds': cost,
+            'paragraphs': paragraphs,
+            'chapters': chapters,
+            'paragraphs_per_sec': paragraphs / cost if cost > 0 else 0,
+            'chapters_per_sec': chapters / cost if cost > 0 else 0,
+            'peak_mb': memory[stage][3],
+        }
+    return result
+
+
+def benchmark_parse(filenames, repeat=3, workers=1):
+    """
+    对比BeautifulSoup与正则扫描两种方式解析电子书的耗时，workers>1时额外测试多进程解析
+    :param filenames: epubs文件夹内的电子书
+    :param repeat: 重复次数，取最短耗时
+    :param workers: 多进程解析使用的进程数量
+    :return: {解析方式: 耗时(s)}
+    """
+    modes = [('soup', False, 1), ('fast', True, 1)]
+    if workers > 1:
+        modes.append(('parallel', True, workers))
+    result = {}
+    for name, fast, n in modes:
+        book.FAST_PARSER = fast
+        cost = float('inf')
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for filename in filenames:
+                Book(filename, save=False, workers=n)
+            cost = min(cost, time.perf_counter() - start)
+        result[name] = cost
+    book.FAST_PARSER = True
+    return result
+
+
+def compare_baseline(results, baseline, tolerance=BENCHMARK_TOLERANCE):
+    """
+    与基准结果对比，找出耗时增加超过tolerance的阶段
+    :param results: {场景: {阶段: 结果}}
+    :param baseline: 之前保存的结果，格式相同
+    :param tolerance: 允许的耗时增加比例
+    :return: [(场景, 阶段, 基准耗时, 当前耗时)...]
+    """
+    regressions = []
+    for scenario, stages in results.items():
+        for stage, stat in stages.items():
+            base = baseline.get(scenario, {}).get(stage)
+            if base is None:
+                continue
+            ratio = stat['seconds'] / base['seconds'] if base['seconds'] > 0 else 1
+            logger.info("%s %s: %.3fs -> %.3fs (%+.0f%%)", scenario, stage, base['seconds'], stat['seconds'],
+                        (ratio - 1) * 100)
+            if ratio > 1 + tolerance and stat['seconds'] - base['seconds'] > BENCHMARK_MIN_DELTA:
+                regressions.append((scenario, stage, base['seconds'], stat['seconds']))
+    return regressions
+
+
+def print_results(results):
+    for scenario, stages in results.items():
+        for stage, stat in stages.items():
+            logger.info("%s %-13s %8.3fs %10.1f 段/s %8.2f 章/s 内存峰值 %7.1fMB", scenario, stage, stat['seconds'],
+                        stat['paragraphs_per_sec'], stat['chapters_per_sec'], stat['peak_mb'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='性能测试')
+    parser.add_argument('book', metavar='book', type=str, nargs='*', help='电子书所在文件，请放在epubs文件夹内',
+                        default=['book1.epub', 'book2.epub'])
+    parser.add_argument('--repeat', type=int, default=3, help='重复次数，取最短耗时')
+    parser.add_argument('--workers', type=int, default=1, help='解析章节使用的进程数量，只测试解析时大于1则额外测试多进程解析')
+    parser.add_argument('--parse_only', action='store_true', help='只对比BeautifulSoup与正则扫描两种解析方式')
+    parser.add_argument('--scale', type=int, nargs='*', default=[4],
+                        help='把英文版的章节复制N份，与自身组成一对合成电子书进行测试，可以指定多个N')
+    parser.add_argument('--align_mode', type=str, default='window', choices=['window', 'matrix'], help='段落对齐算法')
+    parser.add_argument('--baseline', type=str, default=BENCHMARK_BASELINE, help='基准结果文件')
+    parser.add_argument('--save_baseline', action='store_true', help='把本次结果保存为新的基准结果')
+    args = parser.parse_args()
+
+    if args.parse_only:
+        result = benchmark_parse(args.book, repeat=args.repeat, workers=args.workers)
+        logger.info("解析 %s: BeautifulSoup %.3fs, 正则扫描 %.3fs, 加速 %.1f 倍",
+                    ', '.join(args.book), result['soup'], result['fast'], result['soup'] / result['fast'])
+        if 'parallel' in result:
+            logger.info("%d 进程解析 %.3fs", args.workers, result['parallel'])
+        exit()
+
+    os.makedirs(BENCHMARK_DIR, exist_ok=True)
+    align_mode = AlignMode[args.align_mode.upper()]
+    # 假翻译器原样返回英文，英文版与中文版无法匹配，自带的电子书同样与自身配对
+    book1 = args.book[0]
+    scenarios = {'bundled': (book1, book1)}
+    for scale in args.scale:
+        scaled = make_scaled_book(book1, scale)
+        scenarios['x%d' % scale] = (scaled, scaled)
+
+    results = {}
+    for scenario, (left, right) in scenarios.items():
+        logger.info("开始测试 %s: %s - %s", scenario, left, right)
+        results[scenario] = benchmark_pipeline(left, right, repeat=args.repeat, align_mode=align_mode,
+                                               workers=args.workers)
+    print_results(results)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        logger.info("基准结果已保存到 %s", args.baseline)
+    elif os.path.exists(args.baseline):
+        with open(args.baseline, encoding='utf-8') as f:
+            regressions = compare_baseline(results, json.load(f))
+        for scenario, stage, before, after in regressions:
+            logger.warning("性能退化 %s %s: %.3fs -> %.3fs", scenario, stage, before, after)
+        if regressions:
+            exit(1)
@@ -2,16 +2,255 @@
 
 import ebooklib
 from ebooklib import epub
+from ebooklib.utils import get_pages
+from lxml import etree
 import re
-from bs4 import BeautifulSoup
-from translator import Translator, TranslatorType
+import html
+from translator import Translator, TranslateAction, classify_text, TRANSLATE_WORKERS
 import pickle
 import os
+import json
+import time
+import hashlib
+import threading
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
 from settings import *
+from store import StateLog
 
 BOOK_SAVE_DIR = "books"
 PARAGRAPH_HEADER = ['<p>', '<h1>']
-translator = Translator()
+# 使用正则一次扫描完成段落切分与文本提取，关闭后退回每段新建一个BeautifulSoup的方式
+FAST_PARSER = True
+# 解析章节时使用的进程数量，为1时在当前进程中解析
+PARSE_WORKERS = 1
+# 段落的起始标签
+PARAGRAPH_PATTERN = re.compile('<p|<h')
+# 提取纯文本时去掉的注释与标签
+TAG_PATTERN = re.compile(r'<!--.*?-->|<[^>]*>', re.S)
+# 句子的结束位置：中文句末标点，或后面紧跟空白的英文句末标点，句末的引号与括号归入前一句
+SENTENCE_END_PATTERN = re.compile(r'[。！？；…]+[”’"」』）)]*|[.!?]+[”’"\')\]]*(?=\s)')
+# 英文句号前为这些缩写时不断句
+SENTENCE_ABBREVIATIONS = {'mr', 'mrs', 'ms', 'dr', 'st', 'jr', 'sr', 'vs', 'etc', 'no', 'mt', 'prof', 'gen', 'col',
+                          'e.g', 'i.e'}
+# 英文句号前为多个字母加点组成的缩写(如U.S.、U.K.、D.C.)时不断句
+SENTENCE_INITIALISM_PATTERN = re.compile(r'(?:[A-Z]\.){2,}')
+# 短于该长度的片段(如章节编号"7.")与下一句合并
+SENTENCE_MIN_LENGTH = 4
+# 解析后预先计算的摘要段落数，章节匹配时使用
+ABSTRACT_SIZES = (10, 15)
+# 翻译器在第一次使用时创建，只解析或加载存档时不需要初始化翻译客户端
+translator = None
+# 批量模式下多个线程同时解析与翻译，保证只创建一个翻译器
+translator_lock = threading.Lock()
+
+
+def get_translator():
+    """
+    获取当前使用的翻译器，初次调用时按默认设置创建
+    :return: Translator
+    """
+    global translator
+    if translator is None:
+        with translator_lock:
+            if translator is None:
+                translator = Translator()
+    return translator
+
+
+def set_translator(t, cache=True):
+    """
+    更换翻译使用的后端
+    :param t: TranslatorType 或 已注册的翻译后端名称
+    :param cache: 是否使用翻译缓存
+    :return:
+    """
+    global translator
+    with translator_lock:
+        translator = Translator(t, cache=cache)
+
+
+def strip_tags(content):
+    """
+    去掉html片段中的标签与注释，并转换字符实体，得到与BeautifulSoup相同的纯文本
+    :param content: html片段
+    :return:
+    """
+    return html.unescape(TAG_PATTERN.sub('', content)).strip()
+
+
+def split_sentences(text):
+    """
+    按中英文句末标点切分句子，一次正则扫描完成
+    :param text: 段落纯文本
+    :return: [句子...]
+    """
+    ends = []
+    start = 0
+    for m in SENTENCE_END_PATTERN.finditer(text):
+        if m.group().startswith('.'):
+            words = text[start:m.start()].split()
+            if words and words[-1].lower().strip('"“‘(') in SENTENCE_ABBREVIATIONS:
+                continue
+            if words and SENTENCE_INITIALISM_PATTERN.fullmatch(words[-1].lstrip('"“‘(') + m.group()):
+                continue
+        if len(text[start:m.end()].strip()) < SENTENCE_MIN_LENGTH:
+            continue
+        ends.append(m.end())
+        start = m.end()
+    # 结尾剩余的片段过短时并入最后一句
+    if ends and len(text[start:].strip()) < SENTENCE_MIN_LENGTH:
+        ends.pop()
+    ends.append(len(text))
+    starts = [0] + ends[:-1]
+    return [text[s:e].strip() for s, e in zip(starts, ends) if text[s:e].strip()]
+
+
+def content_fingerprint(content):
+    """
+    章节原始内容的指纹，用于判断章节在两次运行之间是否发生变化
+    :param content: bytes 或 str
+    :return:
+    """
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    return hashlib.sha1(content).hexdigest()
+
+
+def get_page_items(book_file):
+    return [_ for _ in book_file.get_items_of_type(ebooklib.ITEM_DOCUMENT) if 'nav' not in _.get_name()]
+
+
+def parse_page_item(name, content):
+    """
+    在子进程中解析一个章节，只返回紧凑的解析结果，由主进程根据结果重建Page
+    :param name: 章节文件名
+    :param content: 章节原始内容
+    :return: Page.get_parse_record()
+    """
+    return Page(epub.EpubItem(file_name=name, content=content), None).get_parse_record()
+
+
+class CombinedEpubWriter(epub.EpubWriter):
+    """
+    逐章写入合并内容的epub写入器，每写完一个章节就恢复其原始内容，内存中只保留当前章节的合并结果
+    """
+
+    def __init__(self, name, book, options=None):
+        super().__init__(name, book.book_file, options)
+        self.pages = {id(page.origin): page for page in book.pages}
+        self.href_table = book.get_href_table()
+        # 合并后各章节中的页码标记，用于生成目录中的页码列表
+        self.page_markers = {}
+
+    def _write_items(self):
+        # 目录依赖合并后的章节内容，放在最后写入
+        nav_items = []
+        for item in self.book.get_items():
+            page = self.pages.get(id(item))
+            if isinstance(item, epub.EpubNcx):
+                self.out.writestr('%s/%s' % (self.book.FOLDER_NAME, item.file_name), self._get_ncx())
+            elif isinstance(item, epub.EpubNav):
+                nav_items.append(item)
+            elif page is not None and item.manifest:
+                original = item.content
+                item.set_content(page.get_page_combined(self.href_table).encode())
+                self.out.writestr('%s/%s' % (self.book.FOLDER_NAME, item.file_name), item.get_content())
+                self.page_markers[id(item)] = get_pages(item)
+                item.content = original
+            elif item.manifest:
+                self.out.writestr('%s/%s' % (self.book.FOLDER_NAME, item.file_name), item.get_content())
+            else:
+                self.out.writestr('%s' % item.file_name, item.get_content())
+        for item in nav_items:
+            self.out.writestr('%s/%s' % (self.book.FOLDER_NAME, item.file_name), self._get_nav(item))
+
+    def _get_nav(self, item):
+        # ebooklib根据章节当前内容生成页码列表，这里先关闭页码列表，再用写入章节时记录的合并后结果生成
+        options = self.options
+        self.options = dict(options, epub3_pages=False)
+        try:
+            nav = super()._get_nav(item)
+        finally:
+            self.options = options
+        if not options.get('epub3_pages'):
+            return nav
+        pages = [_ for i in self.book.get_items_of_type(ebooklib.ITEM_DOCUMENT) if not isinstance(i, epub.EpubNav)
+                 for _ in (self.page_markers[id(i)] if id(i) in self.page_markers else get_pages(i))]
+        if not pages:
+            return nav
+        nav_xml = etree.fromstring(nav, etree.XMLParser(remove_blank_text=True))
+        namespace = etree.QName(nav_xml).namespace
+        body = nav_xml.find('{%s}body' % namespace)
+        nav_dir_name = os.path.dirname(item.file_name)
+        pages_nav = etree.SubElement(body, '{%s}nav' % namespace, {
+            '{%s}type' % epub.NAMESPACES['EPUB']: 'page-list',
+            'id': 'pages',
+            'hidden': 'hidden',
+        })
+        etree.SubElement(pages_nav, '{%s}h2' % namespace).text = options.get('pages_title', 'Pages')
+        pages_ol = etree.SubElement(pages_nav, '{%s}ol' % namespace)
+        for filename, pageref, label in pages:
+            li_item = etree.SubElement(pages_ol, '{%s}li' % namespace)
+            a_item = etree.SubElement(li_item, '{%s}a' % namespace,
+                                      {'href': os.path.relpath('{}#{}'.format(filename, pageref), nav_dir_name)})
+            a_item.text = label
+        return etree.tostring(nav_xml.getroottree(), pretty_print=True, encoding='utf-8', xml_declaration=True)
+
+
+class ChapterStreamWriter:
+    """
+    流式输出，每个章节对齐完成后立即写入 书名_combined 文件夹：
+    合并后的章节html，以及 chapters.jsonl 中的一行段落对照，写完即落盘，不需要等全书对齐
+    """
+
+    def __init__(self, dirname):
+        self.dirname = dirname
+        os.makedirs(dirname, exist_ok=True)
+        self.jsonl = open(os.path.join(dirname, 'chapters.jsonl'), 'w', encoding='utf-8')
+        self.start = time.perf_counter()
+        self.count = 0
+
+    def write(self, page_left, page_right, score, sentences=None):
+        """
+        写入一个对齐完成的章节
+        :param page_left: 英文章节
+        :param page_right: 匹配的中文章节
+        :param score: 章节匹配分数
+        :param sentences: Aligner.align_sentences()的结果，为空时不输出句子对照
+        :return:
+        """
+        with span('Stream_Write', 'io'):
+            basename = os.path.basename(page_left.name)
+            filename = '%04d_%s' % (page_left.index, os.path.splitext(basename)[0] + '.html')
+            with open(os.path.join(self.dirname, filename), 'w', encoding='utf-8') as f:
+                f.write(page_left.get_page_combined())
+            record = {
+                'index': page_left.index, 'page': page_left.name, 'matched_page': page_right.name,
+                'score': float(score), 'html': filename,
+                'paragraphs': [{'index': p.index, 'text': p.text, 'align_score': p.align_score,
+                                'subjects': [_.text for _ in p.subjects]} for p in page_left.paragraphs]}
+            for p, pairs in sentences or []:
+                record['paragraphs'][p.index]['sentences'] = [
+                    {'text': s.text, 'subjects': [_.text for _, _score in subjects],
+                     'scores': [_score for _, _score in subjects]} for s, subjects in pairs]
+            self.jsonl.write(json.dumps(record, ensure_ascii=False) + '\n')
+            self.jsonl.flush()
+        if self.count == 0:
+            logger.info("首个章节已输出到 %s，耗时 %.2fs", self.dirname, time.perf_counter() - self.start)
+        self.count += 1
+        incr('stream_chapters')
+
+    def close(self):
+        self.jsonl.close()
+        logger.info("流式输出完成，共 %d 个章节，保存在 %s", self.count, self.dirname)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
 
 class Book:
@@ -19,69 +258,312 @@ class Book:
     电子书的主体，读取epub文件并解析为不同的pages(章节)
     """
 
-    def __init__(self, filename, save=True, debug=False):
-        self.book_file = epub.read_epub(os.path.join(EPUB_DIR, filename))
+    @time_log('Book_Parse')
+    def __init__(self, filename, save=True, debug=False, workers=PARSE_WORKERS):
         self.filename = filename
         self.if_save = save
-        page_items = list(self.book_file.get_items_of_type(ebooklib.ITEM_DOCUMENT))
-        self.pages = []
-        bar = tqdm(page_items)
-        for item in bar:
-            name = item.get_name()
-            bar.set_description(f'开始解析章节 {name}')
-            if 'nav' not in name:
-                page = Page(item, self)
-                if len(page.head) != 0 and len(page.tail) != 0:
-                    self.pages.append(page)
+        self.source_digest = self.get_source_digest()
+        self.book_file = epub.read_epub(self.get_source_path())
+        self.pages = self.parse_pages(get_page_items(self.book_file), workers)
         # 测试单独章节使用
         if debug:
             self.pages = self.pages[8:10]
+        for index, page in enumerate(self.pages):
+            page.index = index
 
         logger.info("%s 章节解析完成。", self.get_name())
         self.length = self.get_length()
 
-        self.save()
+        # 上次保存之后发生变化的page与paragraph
+        self.dirty = set()
+        self.snapshot()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('dirty', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.dirty = set()
+
+    def parse_pages(self, page_items, workers=PARSE_WORKERS, reuse=None):
+        """
+        解析章节，reuse中同名且内容指纹相同的章节直接沿用，不再重新解析
+        :param page_items: 章节的EpubHtml
+        :param workers: 解析章节使用的进程数量
+        :param reuse: {章节名: Page} 之前的解析结果
+        :return: [Page...]
+        """
+        reuse = reuse or {}
+        todo = [i for i, item in enumerate(page_items)
+                if getattr(reuse.get(item.get_name()), 'fingerprint', None) != content_fingerprint(item.content)]
+
+        # 多进程解析时，把章节原始内容发给子进程，按原顺序取回解析结果
+        # 后台可能有加载模型或翻译的线程，fork会复制它们持有的锁，子进程使用spawn启动
+        records = [None] * len(todo)
+        if workers > 1 and len(todo) > 1:
+            with ProcessPoolExecutor(max_workers=workers, mp_context=get_context('spawn')) as executor:
+                records = list(executor.map(parse_page_item, [page_items[_].get_name() for _ in todo],
+                                            [page_items[_].get_content() for _ in todo],
+                                            chunksize=max(1, len(todo) // (workers * 4))))
+        records = dict(zip(todo, records))
+
+        pages = []
+        bar = tqdm(list(enumerate(page_items)))
+        for i, item in bar:
+            if i not in records:
+                page = reuse[item.get_name()]
+                page.origin = item
+                pages.append(page)
+                continue
+            bar.set_description(f'开始解析章节 {item.get_name()}')
+            with span('Page_Parse'):
+                page = Page(item, self, records[i])
+            if len(page.head) != 0 and len(page.tail) != 0:
+                pages.append(page)
+        return pages
+
+    def get_source_path(self):
+        return os.path.join(EPUB_DIR, self.filename)
+
+    def get_source_digest(self):
+        """
+        :return: epub文件的指纹
+        """
+        with open(self.get_source_path(), 'rb') as f:
+            return content_fingerprint(f.read())
+
+    def update(self, workers=PARSE_WORKERS):
+        """
+        与epub文件对比，只重新解析新增或内容发生变化的章节，其余章节沿用保存的解析、翻译与对齐结果
+        :param workers: 解析章节使用的进程数量
+        :return: 重新解析与删除的章节数量
+        """
+        source_digest = self.get_source_digest()
+        if source_digest == getattr(self, 'source_digest', None):
+            return 0
+        self.book_file = epub.read_epub(self.get_source_path())
+        old = {_.name: _ for _ in self.pages}
+        self.pages = self.parse_pages(get_page_items(self.book_file), workers, reuse=old)
+        for index, page in enumerate(self.pages):
+            page.index = index
+        self.length = self.get_length()
+        self.source_digest = source_digest
+
+        changed = len([_ for _ in self.pages if old.get(_.name) is not _])
+        removed = len(set(old) - set(_.name for _ in self.pages))
+        logger.info("%s 的epub文件发生变化，重新解析 %d 个章节，删除 %d 个章节，其余章节沿用保存的结果",
+                    self.get_name(), changed, removed)
+        self.snapshot()
+        return changed + removed
+
+    def get_save_path(self, suffix='.book'):
+        return os.path.join(BOOK_SAVE_DIR, self.filename.split('.epub')[0] + suffix)
+
+    def mark_dirty(self, obj):
+        """
+        标记发生变化的page或paragraph，下次save时写入日志
+        :param obj: Page 或 Paragraph
+        :return:
+        """
+        self.dirty.add(obj)
 
     def save(self):
         """
-        保存为.book文件
+        保存进度。完整的.book文件只在解析完成时写入一次，之后只把发生变化的page与paragraph追加到.log日志中
+        :return:
+        """
+        if not self.if_save:
+            return
+        if not os.path.exists(self.get_save_path()):
+            self.snapshot()
+            return
+        records = [_.get_record() for _ in self.dirty]
+        with span('Book_Log', 'io'):
+            incr('log_bytes', StateLog(self.get_save_path('.log')).append(records))
+        self.dirty = set()
+
+    def snapshot(self):
+        """
+        把当前完整状态写入.book文件，并清空日志
+        :return:
+        """
+        if not self.if_save:
+            return
+        save_path = self.get_save_path()
+        with span('Book_Snapshot', 'io'):
+            data = pickle.dumps(self)
+            with open(save_path + '.tmp', 'wb') as f:
+                f.write(data)
+            os.replace(save_path + '.tmp', save_path)
+        incr('pickle_bytes', len(data))
+        StateLog(self.get_save_path('.log')).clear()
+        self.dirty = set()
+
+    def replay(self):
+        """
+        读取.book文件后，按顺序重放日志中的记录，恢复最新的进度
+        :return: 日志记录数量
+        """
+        records = StateLog(self.get_save_path('.log')).replay()
+        for record in records:
+            if record[0] == 'page':
+                self.pages[record[1]].set_record(record[2])
+            elif record[0] == 'paragraph':
+                self.pages[record[1]].paragraphs[record[2]].set_record(record[3])
+        return len(records)
+
+    def link(self, other):
+        """
+        恢复指向另一本书的对齐结果，page的对齐结果在保存时只记录另一本书章节的名称，加载后需要重新关联到对应的章节
+        :param other: 对齐的另一本书
         :return:
         """
-        if self.if_save:
-            save_filename = self.filename.split('.epub')[0] + '.book'
-            with open(os.path.join(BOOK_SAVE_DIR, save_filename), 'wb') as f:
-                pickle.dump(self, f)
+        pages = {_.name: _ for _ in other.pages}
+        for page in self.pages:
+            page.link(other, pages)
 
     def get_length(self, translated=False):
         """
-        获取全书长度
+        获取全书长度，原文长度发生变化时同时更新每个章节占全书长度的百分比
         :param translated: True则获取中文翻译版本长度
         :return:
         """
         if translated:
-            self.length = sum([_.get_length(translated=True) for _ in self.pages])
-        else:
-            self.length = sum([page.get_length() for page in self.pages])
+            return sum([_.get_length(translated=True) for _ in self.pages])
+        self.length = sum([page.get_length() for page in self.pages])
+        for page in self.pages:
+            page.stats.set_percent(self.length)
         return self.length
 
-    def get_translate(self):
+    @time_log('Book_Translate')
+    def get_translate(self, para_nums=15, workers=TRANSLATE_WORKERS):
         """
         对每个page进行翻译，途中会保存
+        :param para_nums: 每个page翻译的段落数量
+        :param workers: 同时进行的翻译请求数量
         :return:
         """
-        for page in self.pages:
-            page.translate()
-            self.save()
+        self.translate_pages(self.pages, para_nums=para_nums, workers=workers)
         logger.info("%s 翻译完成", self.get_name())
+        cache = get_translator().cache
+        if cache is not None:
+            logger.info("翻译缓存命中 %d 段，请求翻译 %d 段", cache.hits, cache.misses)
+
+    def translate_pages(self, pages, para_nums=15, workers=TRANSLATE_WORKERS):
+        """
+        翻译多个page的前para_nums段，所有段落打包后并发请求，每当一个page全部翻译完成就保存一次
+        :param pages:
+        :param para_nums: 每个page翻译的段落数量
+        :param workers: 同时进行的翻译请求数量
+        :return:
+        """
+        pages = [_ for _ in pages if not _.is_translated]
+        paragraphs = []
+        pending = {}
+        skipped = {TranslateAction.COPY: 0, TranslateAction.DEFER: 0}
+        candidates = []
+        for page in pages:
+            todo = page.get_translate_todo(para_nums)
+            candidates += todo
+            todo = [p for p in todo if p.prefilter(skipped)]
+            pending[page] = len(todo)
+            paragraphs += todo
+            if len(todo) == 0:
+                page.is_translated = True
+                self.mark_dirty(page)
+        self.log_prefilter(skipped, candidates, paragraphs)
 
-    def save_combined(self):
+        failed = set()
+        with tqdm(total=len(paragraphs)) as bar:
+            bar.set_description(f"正在翻译: {self.get_name()}")
+            texts = [p.text for p in paragraphs]
+            for batch, translations in get_translator().translate_concurrently(texts, workers):
+                page_finished = False
+                for i, translation in zip(batch, translations):
+                    p = paragraphs[i]
+                    # 请求失败的段落保持未翻译，所在章节也不标记完成，下次运行时重新翻译
+                    if translation is None:
+                        failed.add(p.page)
+                        continue
+                    p.set_translation(translation)
+                    pending[p.page] -= 1
+                    if pending[p.page] == 0:
+                        p.page.is_translated = True
+                        self.mark_dirty(p.page)
+                        page_finished = True
+                bar.update(len(batch))
+                if page_finished:
+                    self.save()
+        self.save()
+        if failed:
+            logger.warning("%s 有 %d 个章节的部分段落翻译失败，下次运行时重新翻译", self.get_name(), len(failed))
+
+    def log_prefilter(self, skipped, candidates, paragraphs):
         """
-        将两本书合并之后，保存为新的epub文件
+        记录翻译前筛选跳过的段落数，以及与全部请求翻译相比节省的请求次数
+        :param skipped: {TranslateAction: 段落数}
+        :param candidates: 筛选前需要翻译的段落
+        :param paragraphs: 筛选后需要翻译的段落
         :return:
         """
+        copied, deferred = skipped[TranslateAction.COPY], skipped[TranslateAction.DEFER]
+        if copied + deferred == 0:
+            return
+        t = get_translator()
+        saved = t.count_requests([p.text for p in candidates]) - t.count_requests([p.text for p in paragraphs])
+        incr('translate_filter_copy', copied)
+        incr('translate_filter_defer', deferred)
+        incr('translate_requests_saved', saved)
+        logger.info("%s 翻译前筛选跳过 %d 段（原样保留 %d 段，暂缓 %d 段），节省 %d 次翻译请求",
+                    self.get_name(), copied + deferred, copied, deferred, saved)
+
+    def count_translate_requests(self, pages, para_nums=15):
+        """
+        统计翻译这些page需要翻译的段落数与请求次数，不包括翻译前筛选会跳过的段落
+        :param pages:
+        :param para_nums: 每个page翻译的段落数量
+        :return: (段落数, 请求次数)
+        """
+        texts = [p.text for page in pages if not page.is_translated for p in page.get_translate_todo(para_nums)
+                 if classify_text(p.text) == TranslateAction.TRANSLATE]
+        return len(texts), get_translator().count_requests(texts)
+
+    @time_log('Save_Combined')
+    def save_combined(self, filename=None):
+        """
+        将两本书合并之后，保存为新的epub文件，合并内容逐章生成并写入，不会同时保存整本书的合并结果
+        :param filename: 保存的文件名，默认为 书名_combined.epub
+        :return:
+        """
+        writer = CombinedEpubWriter(filename or self.get_name() + '_combined.epub', self)
+        writer.process()
+        try:
+            writer.write()
+        except IOError as e:
+            logger.warning("合并后的电子书保存失败: %s", e)
+
+    def open_stream(self, dirname=None):
+        """
+        :param dirname: 流式输出的文件夹，默认为 书名_combined
+        :return: ChapterStreamWriter
+        """
+        return ChapterStreamWriter(dirname or self.get_name() + '_combined')
+
+    def get_href_table(self):
+        """
+        预先计算本书每个章节与其对齐章节的超链接地址，合并时直接查表
+        :return: {Page: 超链接地址}
+        """
+        table = {}
         for page in self.pages:
-            page.set_page_combined()
-        epub.write_epub(self.get_name() + '_combined.epub', self.book_file)
+            table[page] = page.get_filename()
+            for p in page.paragraphs:
+                for sub_p in p.subjects:
+                    if sub_p.page not in table:
+                        table[sub_p.page] = sub_p.page.get_filename()
+        return table
 
     def get_name(self):
         book_file = self.book_file
@@ -93,22 +575,30 @@ class Book:
         return title.replace(":", "")[:20]
 
     @staticmethod
-    def open_book(filename, load=True, debug=False):
+    def open_book(filename, load=True, debug=False, workers=PARSE_WORKERS):
         """
         打开一本书，如果已经存在则读取文件，不存在则重新载入
         :param filename: 电子书文件名，默认放在BOOK_SAVE_DIR文件夹下
         :param debug: 测试用选项，打开后只会选取某几个特定page
         :param load: 是否加载本地存档文件
+        :param workers: 解析章节使用的进程数量
         :return:
         """
         save_filename = filename.split('.epub')[0] + '.book'
         if save_filename in os.listdir(BOOK_SAVE_DIR) and load:
-            with open(os.path.join(BOOK_SAVE_DIR, save_filename), 'rb') as f:
-                book = pickle.load(f)
-                logger.info("%s 加载成功。", book.get_name())
-                return book
+            with span('Book_Load', 'io'):
+                with open(os.path.join(BOOK_SAVE_DIR, save_filename), 'rb') as f:
+                    book = pickle.load(f)
+                book.replay()
+            # 只重新解析epub中发生变化的章节
+            book.update(workers)
+            # 日志超过.book文件大小时，合并为新的.book文件
+            if StateLog(book.get_save_path('.log')).size() > os.path.getsize(book.get_save_path()):
+                book.snapshot()
+            logger.info("%s 加载成功。", book.get_name())
+            return book
         else:
-            return Book(filename, debug=debug)
+            return Book(filename, debug=debug, workers=workers)
 
     def reset(self):
         """
@@ -139,22 +629,34 @@ class Book:
 class Page:
     """
     用来处理章节内容的类， 由不同的段落paragraph构成
+    html只保存一份，head, tail, body与各个段落的内容都是其中的一段位置区间，
+    对齐结果以并列的整数数组保存在英文章节上：第i个对齐结果为 subject_left[i]段 <- subject_pages[subject_slot[i]]的subject_right[i]段
     """
-    def __init__(self, item, book):
+    __slots__ = ('book', 'origin', 'name', '_html', 'head_end', 'tail_start', 'body_start', 'body_end',
+                 'paragraphs', 'length', 'is_translated', 'is_aligned', 'bad_aligned', 'abstract', 'index',
+                 'fingerprint', 'align_key', 'subject_pages', 'subject_left', 'subject_slot', 'subject_right',
+                 'align_scores', '_subject_groups', '_stats')
+
+    def __init__(self, item, book, record=None):
         self.book = book
         self.origin = item
         self.name = item.get_name()
-        self.html = item.get_content().decode('utf-8')
+        self._html = item.get_content().decode('utf-8')
+        self.fingerprint = content_fingerprint(item.content)
+        self.paragraphs = []
+        self.index = -1
 
-        # 分离html文件的开头，结尾与主体内容
-        self.body_start = self.body_end = 0
-        self.head = self.extract_head()
-        self.tail = self.extract_tail()
-        self.body = self.html[self.body_start:self.body_end]
+        if record is None:
+            # 分离html文件的开头，结尾与主体内容
+            self.body_start = self.body_end = 0
+            self.head_end = len(self.extract_head())
+            self.tail_start = len(self.html) - len(self.extract_tail())
 
-        # 解析章节中的各个段落
-        self.paragraphs = []
-        self.extract_paragraphs()
+            # 解析章节中的各个段落
+            self.extract_paragraphs()
+        else:
+            self.set_parse_record(record)
+        self._stats = None
         self.length = self.get_length()
 
         # 用于保存当前的状态
@@ -164,6 +666,60 @@ class Page:
 
         self.abstract = ""
 
+        # 对齐结果，align_key记录对齐时另一本书的章节与对齐参数，发生变化时需要重新对齐
+        self.align_key = None
+        self.subject_pages = []
+        self.subject_left = array('i')
+        self.subject_slot = array('i')
+        self.subject_right = array('i')
+        self.align_scores = None
+        self._subject_groups = None
+
+    def __getstate__(self):
+        """
+        html与段落文本不保存，加载后按需重新生成，对齐的另一本书的章节只保存 (书名, 章节位置)
+        统计数据随章节一起保存，加载后不必为了计算长度与摘要重新提取每一段的文本
+        :return:
+        """
+        state = {_: getattr(self, _) for _ in self.__slots__ if hasattr(self, _)}
+        state['_html'] = None
+        state['_subject_groups'] = None
+        state['subject_pages'] = [Page.get_page_ref(_) for _ in self.subject_pages]
+        return state
+
+    def __setstate__(self, state):
+        self.fingerprint = None
+        self.align_key = None
+        self._stats = None
+        for key, value in state.items():
+            setattr(self, key, value)
+        if self._stats is not None:
+            self._stats.page = self
+
+    @property
+    def stats(self):
+        if self._stats is None:
+            self._stats = PageStats(self)
+        return self._stats
+
+    @property
+    def html(self):
+        if self._html is None:
+            self._html = self.origin.get_content().decode('utf-8')
+        return self._html
+
+    @property
+    def head(self):
+        return self.html[:self.head_end]
+
+    @property
+    def tail(self):
+        return self.html[self.tail_start:]
+
+    @property
+    def body(self):
+        return self.html[self.body_start:self.body_end]
+
     def extract_head(self):
         """找到第一个H1或者p的位置，将之前的都默认为header
 
@@ -198,18 +754,42 @@ class Page:
 
     def extract_paragraphs(self):
         """
-        根据标签头，拆分出每一段内容
+        根据标签头，拆分出每一段内容。一次扫描找到所有段落标签头的位置，每一段只记录其在html中的位置区间
         :return: 
         """
-        parts = re.split('(<p|<h)', self.body)
-        parts = [_ for _ in parts if len(_) > 0]
-        if len(parts) < 2:
+        body = self.body
+        starts = [_.start() for _ in PARAGRAPH_PATTERN.finditer(body)]
+        if len(starts) == 0:
             return
+        # 正文不以段落标签开头时，开头部分并入第一段
+        starts[0] = 0
+        ends = starts[1:] + [len(body)]
+        for start, end in zip(starts, ends):
+            para = Paragraph(self.body_start + start, self.body_start + end, self)
+            para.index = len(self.paragraphs)
+            self.paragraphs.append(para)
+
+    def get_parse_record(self):
+        """
+        紧凑的解析结果，只包含各部分的位置与段落的纯文本
+        :return: (head结束位置, tail开始位置, body开始位置, body结束位置, [(段落在body中的结束位置, 段落文本)...])
+        """
+        paragraphs = [(p.end - self.body_start, p.text) for p in self.paragraphs]
+        return self.head_end, self.tail_start, self.body_start, self.body_end, paragraphs
 
-        for i in range(0, int((len(parts) - 1)), 2):
-            content = parts[i] + parts[i + 1]
-            para = Paragraph(content, self)
+    def set_parse_record(self, record):
+        """
+        根据子进程返回的解析结果重建head, tail, body与各个段落的位置
+        :param record: get_parse_record()的返回值
+        :return:
+        """
+        self.head_end, self.tail_start, self.body_start, self.body_end, paragraphs = record
+        start = self.body_start
+        for end, text in paragraphs:
+            para = Paragraph(start, self.body_start + end, self, text=text)
+            para.index = len(self.paragraphs)
             self.paragraphs.append(para)
+            start = self.body_start + end
 
     def print_page_combined(self):
         """
@@ -223,31 +803,56 @@ class Page:
             for _ in subjects:
                 print_color(_.text[:50], Color.GREEN)
 
-    def set_page_combined(self):
+    def release(self):
         """
-        合并已经对齐的内容，替换中文版中注释的超链接地址为当前文件的url
+        释放可以按需重新生成的html与段落文本，流式输出时每写完一章调用，使内存占用不随已处理的章节增加
         :return:
         """
-        content = self.head
-        page_href = self.get_filename()
+        self._html = None
+        for p in self.paragraphs:
+            p._text = None
+
+    def get_page_combined(self, href_table=None):
+        """
+        合并已经对齐的内容，替换中文版中注释的超链接地址为当前文件的url
+        :param href_table: Book.get_href_table()的结果，为空时逐个计算
+        :return: 合并后的html
+        """
+        if href_table is None:
+            href_table = {}
+        page_href = href_table[self] if self in href_table else self.get_filename()
+        fragments = [self.head]
         for p in self.paragraphs:
-            content += p.content
+            fragments.append(p.content)
             for sub_p in p.subjects:
-                sub_page_href = sub_p.page.get_filename()
+                sub_page = sub_p.page
+                sub_page_href = href_table[sub_page] if sub_page in href_table else sub_page.get_filename()
                 if page_href and sub_page_href:
-                    content += sub_p.content.replace(sub_page_href, page_href)
+                    fragments.append(sub_p.content.replace(sub_page_href, page_href))
                 else:
-                    content += sub_p.content
-        content += self.tail
-        self.origin.set_content(content.encode())
+                    fragments.append(sub_p.content)
+        fragments.append(self.tail)
+        return ''.join(fragments)
 
     def get_abstract(self, n=10, translated=False):
         """
-        获取本章前n段的内容作为摘要，用于比较相似度
+        获取本章前n段的内容作为摘要，用于比较相似度，结果缓存在stats中
         :param translated: 是否获取中文版本
         :param n: 获取前n段内容作为摘要
         :return:
         """
+        abstract = self.stats.get_abstract(n, translated)
+        if translated:
+            self.abstract = abstract
+        return abstract
+
+    def build_abstract(self, n=10, translated=False):
+        """
+        拼接前n段非空段落的内容
+        :param translated: 是否使用译文
+        :param n:
+        :return:
+        """
         abstract = ""
         i = 0
         for p in self.paragraphs:
@@ -257,8 +862,6 @@ class Page:
                 i += 1
             if i >= n:
                 break
-        if translated:
-            self.abstract = abstract
         return abstract
 
     def get_length(self, translated=False):
@@ -268,11 +871,22 @@ class Page:
         :return:
         """
         if translated:
-            self.length = sum([len(p.translation) for p in self.paragraphs])
-        else:
-            self.length = sum([len(p.text) for p in self.paragraphs])
+            return self.stats.get_translated_length()
+        self.length = self.stats.length
         return self.length
 
+    def invalidate_translation(self):
+        """译文发生变化后，丢弃缓存的译文长度与译文摘要"""
+        if self._stats is not None:
+            self._stats.reset_translation()
+
+    def get_translate_todo(self, para_nums=15):
+        """
+        :param para_nums: 翻译的段落数量
+        :return: 前para_nums段中需要翻译的段落
+        """
+        return [p for p in self.paragraphs[:para_nums] if p.need_translate()]
+
     @time_log('Page_Translate')
     def translate(self, para_nums=15):
         """
@@ -283,24 +897,126 @@ class Page:
         # logger.info("正在翻译章节：%s", self.name)
         if self.is_translated:
             return
-        bar = tqdm(self.paragraphs[:para_nums])
-
-        for i, p in enumerate(bar):
-            bar.set_description(f"正在翻译章节: {self.name}")
-            p.get_translate()
-            if i % 5 == 0:
-                self.book.save()
-        self.is_translated = True
-        self.book.save()
+        self.book.translate_pages([self], para_nums=para_nums)
 
     def save(self):
+        self.book.mark_dirty(self)
         self.book.save()
 
+    def add_subject(self, index, paragraph, score=0):
+        """
+        为第index段增加一段对应的译文
+        :param index: 本章段落位置
+        :param paragraph: 译文段落
+        :param score: 匹配分数
+        :return:
+        """
+        if paragraph.page in self.subject_pages:
+            slot = self.subject_pages.index(paragraph.page)
+        else:
+            slot = len(self.subject_pages)
+            self.subject_pages.append(paragraph.page)
+        self.subject_left.append(index)
+        self.subject_slot.append(slot)
+        self.subject_right.append(paragraph.index)
+        self.set_align_score(index, score)
+        self._subject_groups = None
+        self.book.mark_dirty(self)
+
+    def get_subjects(self, index):
+        """
+        获取第index段对应的所有译文，第一次调用时把对齐结果按段落分组
+        :param index: 本章段落位置
+        :return: [Paragraph...]
+        """
+        if self._subject_groups is None:
+            groups = {}
+            for left, slot, right in zip(self.subject_left, self.subject_slot, self.subject_right):
+                page = self.subject_pages[slot]
+                # 尚未关联的另一本书的章节
+                if isinstance(page, tuple):
+                    continue
+                groups.setdefault(left, []).append(page.paragraphs[right])
+            self._subject_groups = groups
+        return list(self._subject_groups.get(index, []))
+
+    def remove_subjects(self, index=None):
+        """
+        删除第index段的对齐结果，index为None时删除全部
+        :param index: 本章段落位置
+        :return:
+        """
+        if index is None:
+            self.subject_pages = []
+            keep = []
+        else:
+            keep = [i for i, left in enumerate(self.subject_left) if left != index]
+        self.subject_left = array('i', [self.subject_left[_] for _ in keep])
+        self.subject_slot = array('i', [self.subject_slot[_] for _ in keep])
+        self.subject_right = array('i', [self.subject_right[_] for _ in keep])
+        self._subject_groups = None
+        self.book.mark_dirty(self)
+
+    def get_align_score(self, index):
+        return 0 if self.align_scores is None else self.align_scores[index]
+
+    def set_align_score(self, index, score):
+        if self.align_scores is None:
+            self.align_scores = array('f', [0]) * len(self.paragraphs)
+        self.align_scores[index] = score
+
+    @staticmethod
+    def get_page_ref(page):
+        """
+        :param page: Page 或 已经是 (书名, 章节名) 的引用
+        :return: (书名, 章节名)，章节名在重新解析后不变
+        """
+        if isinstance(page, tuple):
+            return page
+        return page.book.filename, page.name
+
+    def link(self, other, pages=None):
+        """
+        把指向other的对齐结果重新关联到other中的章节，对应章节已经删除或内容发生变化时，重置本章的对齐结果
+        :param other: Book
+        :param pages: {章节名: Page}，为空时根据other生成
+        :return:
+        """
+        if pages is None:
+            pages = {_.name: _ for _ in other.pages}
+        stale = False
+        for slot, page in enumerate(self.subject_pages):
+            if isinstance(page, tuple) and page[0] == other.filename:
+                if page[1] in pages:
+                    self.subject_pages[slot] = pages[page[1]]
+                    self._subject_groups = None
+                else:
+                    stale = True
+        if self.align_key is not None and self.align_key[0] == other.filename:
+            page = pages.get(self.align_key[1])
+            stale = stale or page is None or page.fingerprint != self.align_key[2]
+        if stale:
+            logger.info("章节 %s 对齐的章节发生变化，需要重新对齐", self.name)
+            self.reset()
+
     def reset(self):
         """重置后方便重新对齐"""
         self.is_aligned = False
-        for p in self.paragraphs:
-            p.reset()
+        self.bad_aligned = False
+        self.align_key = None
+        self.remove_subjects()
+
+    def get_record(self):
+        return 'page', self.index, {
+            'is_translated': self.is_translated, 'is_aligned': self.is_aligned, 'bad_aligned': self.bad_aligned,
+            'align_key': self.align_key, 'subject_pages': [Page.get_page_ref(_) for _ in self.subject_pages],
+            'subject_left': self.subject_left, 'subject_slot': self.subject_slot, 'subject_right': self.subject_right,
+            'align_scores': self.align_scores}
+
+    def set_record(self, state):
+        for key, value in state.items():
+            setattr(self, key, value)
+        self._subject_groups = None
 
     def get_filename(self):
         """
@@ -315,15 +1031,46 @@ class Page:
 
 
 class Paragraph:
-    def __init__(self, content, page):
+    """
+    段落只记录其在章节html中的位置区间，内容与纯文本按需生成
+    """
+    __slots__ = ('page', 'index', 'start', 'end', '_text', 'translation', 'is_translated')
+
+    def __init__(self, start, end, page, text=None):
         self.page = page
-        self.content = content
-        self.text = self.extract_text()
-        self.subjects = []
-        self.align_score = 0
+        self.index = -1
+        self.start = start
+        self.end = end
+        self._text = text
         self.translation = ''
         self.is_translated = False
 
+    def __getstate__(self):
+        return {_: getattr(self, _) for _ in self.__slots__ if _ != '_text'}
+
+    def __setstate__(self, state):
+        self._text = None
+        for key, value in state.items():
+            setattr(self, key, value)
+
+    @property
+    def content(self):
+        return self.page.html[self.start:self.end]
+
+    @property
+    def text(self):
+        if self._text is None:
+            self._text = self.extract_text()
+        return self._text
+
+    @property
+    def subjects(self):
+        return self.page.get_subjects(self.index)
+
+    @property
+    def align_score(self):
+        return self.page.get_align_score(self.index)
+
     def add_subject(self, paragraph, score=0):
         """增加一段对应的译文， 记录译文的匹配分数
 
@@ -331,47 +1078,142 @@ class Paragraph:
             paragraph (_type_): _description_
             :param score:
         """
-        self.subjects.append(paragraph)
-        self.align_score = score
+        self.page.add_subject(self.index, paragraph, score)
 
     def extract_sentences(self):
-        """提取出每一句句子
-
-        Returns:
-            _type_: _description_
         """
-        sentences = re.split(r'\.|!', self.text)
-        sentences = [_ for _ in sentences if len(_) > 0]
-        sentences = [Sentence(_) for _ in sentences]
-        return sentences
+        提取出每一句句子
+        :return: [Sentence...]
+        """
+        return [Sentence(text, self, i) for i, text in enumerate(split_sentences(self.text))]
 
     def extract_text(self):
+        if FAST_PARSER:
+            return strip_tags(self.content)
+        from bs4 import BeautifulSoup
         soup = BeautifulSoup(self.content, 'html.parser')
         return soup.text.strip()
 
     @time_log("Paragraph_Translate", preview=False)
     def get_translate(self):
-        if len(self.text) < 2 or self.is_translated:
+        if not self.need_translate():
             return
-        self.translation = translator.translate(self.text)
+        if classify_text(self.text) == TranslateAction.COPY:
+            self.set_translation(self.text)
+            return
+        translation = get_translator().translate(self.text)
+        if translation is not None:
+            self.set_translation(translation)
+
+    def need_translate(self):
+        return len(self.text) >= 2 and not self.is_translated
+
+    def prefilter(self, skipped=None):
+        """
+        翻译前的筛选，不值得请求翻译的段落直接以原文作为译文：
+        COPY的段落视为翻译完成，DEFER的段落暂用原文，之后单独调用get_translate时仍会翻译
+        :param skipped: {TranslateAction: 段落数}，用于统计
+        :return: 是否需要请求翻译
+        """
+        action = classify_text(self.text)
+        if action == TranslateAction.TRANSLATE:
+            return True
+        if action == TranslateAction.COPY:
+            self.set_translation(self.text)
+        elif self.translation != self.text:
+            self.translation = self.text
+            self.page.invalidate_translation()
+            self.page.book.mark_dirty(self)
+        if skipped is not None:
+            skipped[action] += 1
+        return False
+
+    def set_translation(self, translation):
+        self.translation = translation
         self.is_translated = True
+        self.page.invalidate_translation()
+        self.page.book.mark_dirty(self)
 
     def reset(self):
-        self.subjects = []
+        self.page.remove_subjects(self.index)
+
+    def get_record(self):
+        return 'paragraph', self.page.index, self.index, {
+            'translation': self.translation, 'is_translated': self.is_translated}
+
+    def set_record(self, state):
+        for key, value in state.items():
+            setattr(self, key, value)
+        self.page.invalidate_translation()
+
+
+class PageStats:
+    """
+    章节的统计数据：原文长度、占全书长度的百分比与前10/15段的摘要在解析后计算一次，
+    译文长度与译文摘要在第一次使用时计算，译文发生变化后重新计算
+    """
+    __slots__ = ('page', 'length', 'percent', 'translated_length', 'abstracts')
+
+    def __init__(self, page):
+        self.page = page
+        self.length = sum([len(p.text) for p in page.paragraphs])
+        self.percent = 0
+        self.set_percent(getattr(page.book, 'length', 0))
+        self.translated_length = None
+        # (n, translated) -> 摘要
+        self.abstracts = {(n, False): page.build_abstract(n) for n in ABSTRACT_SIZES}
+
+    def __getstate__(self):
+        return {_: getattr(self, _) for _ in self.__slots__ if _ != 'page'}
+
+    def __setstate__(self, state):
+        self.page = None
+        for key, value in state.items():
+            setattr(self, key, value)
+
+    def set_percent(self, book_length):
+        """
+        :param book_length: 全书原文长度
+        :return:
+        """
+        self.percent = self.length / book_length * 100 if book_length else 0
+
+    def get_abstract(self, n=10, translated=False):
+        key = (n, translated)
+        if key not in self.abstracts:
+            self.abstracts[key] = self.page.build_abstract(n, translated)
+        return self.abstracts[key]
+
+    def get_translated_length(self):
+        if self.translated_length is None:
+            self.translated_length = sum([len(p.translation) for p in self.page.paragraphs])
+        return self.translated_length
+
+    def reset_translation(self):
+        self.translated_length = None
+        for key in [_ for _ in self.abstracts if _[1]]:
+            del self.abstracts[key]
 
 
 class Sentence:
     """
-    Deprecated, 本来可以用作逐句的翻译对齐
+    段落中的一句，用于在已经对齐的段落内部进行句子对齐，按需生成，不保存
     """
+    __slots__ = ('paragraph', 'index', 'text', 'translation')
 
-    def __init__(self, text):
+    def __init__(self, text, paragraph=None, index=-1):
+        self.paragraph = paragraph
+        self.index = index
         self.text = text
         self.translation = ''
-        self.translate()
 
     def translate(self):
-        self.translation = translator.detect_before_translate(self.text)
+        """
+        需要时再单独翻译，多语言模型对齐句子时不需要翻译
+        :return:
+        """
+        self.translation = get_translator().detect_before_translate(self.text) or ''
+        return self.translation
 
 
 if __name__ == '__main__':
@@ -0,0 +1,341 @@
+# -*- coding: utf-8 -*-
+
+import atexit
+import hashlib
+import os
+import pickle
+import threading
+import time
+import zlib
+import numpy as np
+from enum import Enum
+from settings import *
+
+# 文本相似度模型，第一次使用时初始化
+MODEL_NAME = 'sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2'
+# 每次送入模型的文本数量
+EMBEDDING_BATCH_SIZE = 64
+# 向量磁盘缓存的位置与最多保存的向量数量，超出后最早写入的向量会被覆盖
+EMBEDDING_CACHE_DIR = os.path.join('temp', 'embeddings')
+EMBEDDING_CACHE_SIZE = 100000
+# text_digest 的长度，sha1为20字节
+DIGEST_SIZE = 20
+
+
+
+class EmbeddingBackend(Enum):
+    TORCH = 1  # text2vec + PyTorch，全精度
+    ONNX = 2  # 导出并int8量化的同一模型，onnxruntime在CPU上推理，见 onnx_embedding.py
+
+
+sim_model = None
+vector_cache = None
+embedding_backend = EmbeddingBackend.TORCH
+# 加载模型时持有，后台预加载与第一次使用同时发生时只加载一次
+model_lock = threading.Lock()
+warm_up_thread = None
+
+
+def get_sim_model():
+    """
+    获取文本相似度模型，初次调用时加载，后台正在预加载时等待其完成
+    :return: text2vec.Similarity
+    """
+    if sim_model is None:
+        with span('Model_Wait', 'model'):
+            load_sim_model()
+    return sim_model
+
+
+def load_sim_model():
+    global sim_model
+    with model_lock:
+        if sim_model is None:
+            with span('Model_Load', 'model', backend=embedding_backend.name):
+                if embedding_backend == EmbeddingBackend.ONNX:
+                    from onnx_embedding import OnnxSimilarity
+                    sim_model = OnnxSimilarity()
+                else:
+                    from text2vec import Similarity
+                    sim_model = Similarity(model_name_or_path=MODEL_NAME)
+
+
+def set_embedding_backend(backend):
+    """
+    更换文本相似度模型的推理后端，已经加载的模型与向量缓存一起丢弃，
+    两种后端的向量存在微小差异，磁盘缓存分开保存
+    :param backend: EmbeddingBackend
+    :return:
+    """
+    global embedding_backend, sim_model, vector_cache
+    if backend == embedding_backend:
+        return
+    with model_lock:
+        embedding_backend = backend
+        sim_model = None
+    if vector_cache is not None:
+        vector_cache.flush()
+        vector_cache = None
+
+
+def get_model_key():
+    """
+    :return: 当前模型与推理后端的名称，用于区分向量缓存
+    """
+    if embedding_backend == EmbeddingBackend.ONNX:
+        return MODEL_NAME + '-onnx-int8'
+    return MODEL_NAME
+
+
+def warm_up():
+    """
+    在后台线程中加载文本相似度模型，与解析、翻译同时进行，章节匹配开始时不必再等待模型加载
+    :return: 后台线程，模型已经加载时返回None
+    """
+    global warm_up_thread
+    if sim_model is not None or warm_up_thread is not None:
+        return warm_up_thread
+
+    def load():
+        start = time.perf_counter()
+        try:
+            load_sim_model()
+        except Exception as e:
+            logger.warning("后台加载模型失败，将在第一次使用时重新加载: %s", e)
+            return
+        logger.info("后台加载模型完成，耗时 %.2fs", time.perf_counter() - start)
+
+    warm_up_thread = threading.Thread(target=load, name='model_warm_up', daemon=True)
+    warm_up_thread.start()
+    return warm_up_thread
+
+
+def get_vector_cache():
+    """
+    获取进程内共享的向量磁盘缓存
+    :return: VectorCache
+    """
+    global vector_cache
+    if vector_cache is None:
+        vector_cache = VectorCache(get_model_key())
+        atexit.register(vector_cache.flush)
+    return vector_cache
+
+
+def text_digest(text, model_name=MODEL_NAME):
+    """
+    文本与模型名称共同计算的摘要，作为向量缓存的键，避免缓存中保存整段原文
+    :param text:
+    :param model_name:
+    :return: 20字节的sha1摘要
+    """
+    return hashlib.sha1((model_name + '\0' + text).encode('utf-8')).digest()
+
+
+def normalize(vectors):
+    """
+    将向量归一化，之后点积即为余弦相似度
+    :param vectors: (n, d) 矩阵
+    :return:
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+class EmbeddingStore:
+    """
+    文本向量仓库，每段文本只经过一次模型计算，归一化后的向量按行保存在同一个矩阵中
+    """
+
+    def __init__(self, batch_size=EMBEDDING_BATCH_SIZE, cache=True):
+        self.batch_size = batch_size
+        self.rows = {}  # 文本摘要 -> 矩阵中的行号
+        self.matrix = None
+        self.size = 0
+        self.disk_cache = get_vector_cache() if cache else None
+
+    def encode(self, texts):
+        """
+        获取一组文本的向量，未计算过的文本先查磁盘缓存，仍然没有的去重后分批送入模型
+        :param texts: 文本列表
+        :return: (len(texts), d) 的归一化向量矩阵
+        """
+        digests = [text_digest(_) for _ in texts]
+        missing = {}
+        for digest, text in zip(digests, texts):
+            if digest not in self.rows:
+                missing[digest] = text
+
+        incr('embedding_memory_hits', len(texts) - len(missing))
+        if missing and self.disk_cache is not None:
+            found = self.disk_cache.get(list(missing))
+            incr('embedding_disk_hits', len(found))
+            if found:
+                self.add(list(found), np.stack(list(found.values())))
+                for digest in found:
+                    del missing[digest]
+
+        if missing:
+            model = get_sim_model()
+            missing = list(missing.items())
+            for start in range(0, len(missing), self.batch_size):
+                batch = missing[start: start + self.batch_size]
+                with span('Model_Encode', 'model', texts=len(batch)):
+                    vectors = model.model.encode([_[1] for _ in batch], batch_size=self.batch_size)
+                incr('model_calls')
+                incr('model_texts', len(batch))
+                vectors = normalize(vectors)
+                self.add([_[0] for _ in batch], vectors)
+                if self.disk_cache is not None:
+                    self.disk_cache.put([_[0] for _ in batch], vectors)
+
+        if not texts:
+            return np.zeros((0, 0 if self.matrix is None else self.matrix.shape[1]), dtype=np.float32)
+        return self.matrix[[self.rows[_] for _ in digests]]
+
+    def add(self, digests, vectors):
+        """
+        把新的向量追加到矩阵末尾，容量不足时成倍扩容
+        :param digests: 文本摘要
+        :param vectors: 已经归一化的向量
+        :return:
+        """
+        if self.matrix is None:
+            self.matrix = np.zeros((max(len(digests), self.batch_size), vectors.shape[1]), dtype=np.float32)
+        if self.size + len(digests) > len(self.matrix):
+            capacity = max(len(self.matrix) * 2, self.size + len(digests))
+            matrix = np.zeros((capacity, self.matrix.shape[1]), dtype=np.float32)
+            matrix[:self.size] = self.matrix[:self.size]
+            self.matrix = matrix
+        self.matrix[self.size: self.size + len(digests)] = vectors
+        for i, digest in enumerate(digests):
+            self.rows[digest] = self.size + i
+        self.size += len(digests)
+
+    def flush(self):
+        if self.disk_cache is not None:
+            self.disk_cache.flush()
+
+
+class VectorCache:
+    """
+    向量磁盘缓存，保存在内存映射的定长记录数组中，每行记录为 (文本摘要, 校验和, 向量)
+    数组大小固定，写满后按写入顺序循环覆盖最早的向量
+    摘要与向量保存在同一行，读取时核对摘要与校验和，覆盖到一半时程序退出也不会返回其他文本的向量；
+    索引在加载时由各行的摘要重建，保存时只需写回改动过的内存页与很小的元数据文件
+    """
+
+    def __init__(self, model_name, cache_dir=EMBEDDING_CACHE_DIR, capacity=EMBEDDING_CACHE_SIZE):
+        os.makedirs(cache_dir, exist_ok=True)
+        name = model_name.replace('/', '_')
+        self.vector_file = os.path.join(cache_dir, name + '.rows')
+        self.meta_file = os.path.join(cache_dir, name + '.meta')
+        self.capacity = capacity
+        self.dim = 0
+        self.next = 0  # 下一个写入位置
+        self.index = {}  # 摘要 -> 行号
+        self.rows = None
+        self.dirty = False
+        self.load()
+
+    @staticmethod
+    def row_dtype(dim):
+        return np.dtype([('digest', np.uint8, (DIGEST_SIZE,)), ('checksum', '<u4'), ('vector', '<f4', (dim,))])
+
+    @staticmethod
+    def checksum(digest, vector):
+        return zlib.crc32(np.ascontiguousarray(vector, dtype='<f4').tobytes(), zlib.crc32(digest))
+
+    def load(self):
+        """
+        读取已有的向量文件，由每行的摘要重建索引，文件损坏或配置变化时重新建立缓存
+        :return:
+        """
+        if not (os.path.exists(self.meta_file) and os.path.exists(self.vector_file)):
+            return
+        try:
+            with open(self.meta_file, 'rb') as f:
+                state = pickle.load(f)
+        except Exception as e:
+            logger.warning("向量缓存元数据读取失败，将重新建立缓存: %s", e)
+            return
+        if state['capacity'] != self.capacity:
+            logger.info("向量缓存容量发生变化，将重新建立缓存")
+            return
+        dtype = VectorCache.row_dtype(state['dim'])
+        if os.path.getsize(self.vector_file) != dtype.itemsize * self.capacity:
+            logger.warning("向量缓存文件大小不正确，将重新建立缓存")
+            return
+        self.dim, self.next = state['dim'], state['next']
+        self.rows = np.memmap(self.vector_file, dtype=dtype, mode='r+', shape=(self.capacity,))
+        digests = np.asarray(self.rows['digest'])
+        for row in np.flatnonzero(digests.any(axis=1)):
+            self.index[digests[row].tobytes()] = int(row)
+
+    def create(self, dim):
+        self.dim = dim
+        self.next = 0
+        self.index = {}
+        self.rows = np.memmap(self.vector_file, dtype=VectorCache.row_dtype(dim), mode='w+', shape=(self.capacity,))
+
+    def get(self, digests):
+        """
+        :param digests: 文本摘要列表
+        :return: {摘要: 向量}，只包含命中的部分，摘要或校验和对不上的行视为未命中
+        """
+        if self.rows is None:
+            return {}
+        found = {}
+        for digest in digests:
+            row = self.index.get(digest)
+            if row is None:
+                continue
+            record = self.rows[row]
+            vector = np.array(record['vector'])
+            if record['digest'].tobytes() != digest or int(record['checksum']) != VectorCache.checksum(digest, vector):
+                incr('embedding_disk_corrupt')
+                del self.index[digest]
+                continue
+            found[digest] = vector
+        return found
+
+    def put(self, digests, vectors):
+        """
+        写入新的向量，覆盖最早写入的位置
+        :param digests:
+        :param vectors: 已经归一化的向量
+        :return:
+        """
+        if self.rows is None or self.dim != vectors.shape[1]:
+            self.create(vectors.shape[1])
+        for digest, vector in zip(digests, vectors):
+            if digest in self.index:
+                continue
+            row = self.next
+            evicted = self.rows[row]['digest'].tobytes()
+            if self.index.get(evicted) == row:
+                del self.index[evicted]
+            self.rows[row] = (np.frombuffer(digest, dtype=np.uint8), VectorCache.checksum(digest, vector), vector)
+            self.index[digest] = row
+            self.next = (row + 1) % self.capacity
+        self.dirty = True
+
+    def flush(self):
+        """
+        把改动过的向量写回磁盘并保存写入位置，元数据先写入临时文件再替换
+        :return:
+        """
+        if not self.dirty:
+            return
+        with span('Vector_Cache_Flush', 'io'):
+            self.write()
+
+    def write(self):
+        self.rows.flush()
+        temp_file = self.meta_file + '.tmp'
+        with open(temp_file, 'wb') as f:
+            pickle.dump({'dim': self.dim, 'capacity': self.capacity, 'next': self.next}, f)
+        os.replace(temp_file, self.meta_file)
+        self.dirty = False
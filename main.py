@@ -1,44 +1,243 @@
+import time
+IMPORT_START = time.perf_counter()
 from settings import *
 from book import *
 from match import *
+from embedding import warm_up, set_embedding_backend, EmbeddingBackend
+from translator import TranslatorType
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import nullcontext
 import argparse
+import os
+IMPORT_TIME = time.perf_counter() - IMPORT_START
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description='manual to this script')
-    parser.add_argument('book', metavar='book', type=str, nargs='*', help='电子书所在文件，请放在epubs文件夹内',
-                        default=['book1.epub', 'book2.epub'])
-    parser.add_argument('--preview', type=bool, default=True, help='是否打开预览功能，会在每个章节对齐后展示对齐内容, 默认开启')
-    parser.add_argument('--load', type=bool, default=True, help='是否加载本地保存的内容，继续执行任务，默认开启')
 
-    args = parser.parse_args()
+def prepare_pair(book1, book2, load=True, parse_workers=1, match_mode=MatchMode.TRANSLATE):
+    """
+    解析与翻译阶段，耗时主要在网络请求上
+    :param book1: 英文版文件名
+    :param book2: 中文版文件名
+    :param load: 是否加载本地保存的内容
+    :param parse_workers: 解析章节使用的进程数量
+    :param match_mode: 章节匹配方式，DIRECT模式下不预先翻译
+    :return: book_en, book_zn
+    """
+    book_en = Book.open_book(book1, load=load, debug=False, workers=parse_workers)
+    book_zn = Book.open_book(book2, load=load, workers=parse_workers)
+
+    if match_mode == MatchMode.TRANSLATE:
+        book_en.get_translate()
+    return book_en, book_zn
+
+
+def align_pages(matcher, aligner, preview=False, workers=1):
+    """
+    按章节顺序逐章对齐，每对齐完成一章就交给调用方，已经对齐的章节直接返回
+    :param matcher: 完成匹配的PageMatcher
+    :param aligner:
+    :param preview: 是否在每个章节对齐后展示对齐内容
+    :param workers: 段落对齐使用的进程数量，大于1时各章节分配到进程池中并行对齐
+    :return: 生成 (英文章节, 中文章节, 匹配分数)
+    """
+    matched_pages = sorted(matcher.matched_pages, key=lambda x: x[0].index)
+    # 重新匹配后不再有对应章节的英文章节，清除之前的对齐结果，避免合并输出时仍然带上旧的译文
+    book_en = matcher.get_books()[0]
+    matched_left = set(_[0] for _ in matched_pages)
+    stale_pages = [_ for _ in book_en.pages if (_.is_aligned or _.bad_aligned) and _ not in matched_left]
+    for page in stale_pages:
+        page.reset()
+        book_en.mark_dirty(page)
+    if stale_pages:
+        logger.info("%d 个章节已经没有对应的中文章节，清除原来的对齐结果", len(stale_pages))
+        book_en.save()
+    for page1, page2, score in matched_pages:
+        # 对应章节或对齐参数发生变化时重新对齐
+        if page1.is_aligned and page1.align_key != aligner.get_align_key(page2):
+            page1.reset()
+    todo = [(page1, page2) for page1, page2, score in matched_pages if not page1.is_aligned]
+    todo_index = set(page1.index for page1, page2 in todo)
+    aligned = aligner.align_parallel(todo, workers)
+    for page1, page2, score in matched_pages:
+        # 需要对齐的章节按相同的顺序从对齐结果中取出
+        if page1.index in todo_index:
+            next(aligned)
+            if preview:
+                page1.print_page_combined()
+        yield page1, page2, score
+
+
+def align_pair(book_en, book_zn, load=True, preview=False, align_mode=AlignMode.WINDOW,
+               match_mode=MatchMode.TRANSLATE, match_algorithm=MatchAlgorithm.GREEDY, stream=False,
+               sentence_align=False, align_workers=1):
+    """
+    章节匹配、段落对齐与合并输出阶段，耗时主要在模型计算上
+    :param book_en: 英文版
+    :param book_zn: 中文版
+    :param load: 是否加载本地保存的内容
+    :param preview: 是否在每个章节对齐后展示对齐内容
+    :param align_mode: 段落对齐算法
+    :param match_mode: 章节匹配方式
+    :param match_algorithm: 章节匹配算法
+    :param stream: 是否在每个章节对齐后立即输出该章节
+    :param sentence_align: 是否在对齐的段落内部继续进行句子对齐，结果写入流式输出
+    :param align_workers: 段落对齐使用的进程数量
+    :return: 合并后的英文版
+    """
+    matcher = PageMatcher.open_matcher(book_en, book_zn, load=load, mode=match_mode, algorithm=match_algorithm)
+    matcher.check_page_num()
+    book_en, book_zn = matcher.get_books()
+    matcher.match()
+    aligner = Aligner(mode=align_mode)
+
+    if sentence_align and not stream:
+        logger.info("句子对齐的结果保存在流式输出中，自动开启 --stream")
+        stream = True
+    if stream:
+        with book_en.open_stream() as writer:
+            for page1, page2, score in align_pages(matcher, aligner, preview, align_workers):
+                sentences = aligner.align_sentences(page1) if sentence_align else None
+                writer.write(page1, page2, score, sentences)
+                page1.release()
+                page2.release()
+    else:
+        for _ in align_pages(matcher, aligner, preview, align_workers):
+            pass
+    book_en.save_combined()
+    return book_en
+
+
+def read_manifest(filename):
+    """
+    读取批量任务清单，每行为一对电子书：英文版 中文版，以空格或逗号分隔，#开头的行为注释
+    :param filename:
+    :return: [(英文版, 中文版)...]
+    """
+    pairs = []
+    with open(filename, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if len(line) == 0 or line.startswith('#'):
+                continue
+            parts = line.replace(',', ' ').split()
+            if len(parts) != 2:
+                logger.warning("无法识别的任务: %s", line)
+                continue
+            if (parts[0], parts[1]) in pairs:
+                logger.warning("重复的任务: %s", line)
+                continue
+            pairs.append((parts[0], parts[1]))
+    return pairs
+
+
+def run_batch(pairs, workers=2, load=True, parse_workers=1, align_mode=AlignMode.WINDOW,
+              match_mode=MatchMode.TRANSLATE, match_algorithm=MatchAlgorithm.GREEDY, stream=False,
+              sentence_align=False, align_workers=1):
+    """
+    批量处理多对电子书，解析与翻译在线程池中并发进行，
+    每完成一对就在主线程中进行匹配与对齐，模型只加载一次，一对书的翻译与另一对书的模型计算同时进行
+    :param pairs: [(英文版, 中文版)...]
+    :param workers: 同时解析与翻译的电子书对数
+    :param load: 是否加载本地保存的内容
+    :param parse_workers: 解析章节使用的进程数量
+    :param align_mode: 段落对齐算法
+    :param match_mode: 章节匹配方式
+    :param match_algorithm: 章节匹配算法
+    :param stream: 是否在每个章节对齐后立即输出该章节
+    :param sentence_align: 是否在对齐的段落内部继续进行句子对齐
+    :param align_workers: 段落对齐使用的进程数量
+    :return: 失败的任务列表
+    """
+    failed = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(prepare_pair, book1, book2, load, parse_workers, match_mode): (book1, book2)
+                   for book1, book2 in pairs}
+        # 解析与翻译进行的同时加载模型，之后所有电子书共用
+        get_sim_model()
+        for i, future in enumerate(as_completed(futures)):
+            book1, book2 = futures[future]
+            try:
+                book_en, book_zn = future.result()
+                align_pair(book_en, book_zn, load=load, align_mode=align_mode, match_mode=match_mode,
+                           match_algorithm=match_algorithm, stream=stream, sentence_align=sentence_align,
+                           align_workers=align_workers)
+                logger.info("[%d/%d] %s - %s 合并完成", i + 1, len(pairs), book1, book2)
+            except Exception as e:
+                logger.exception("%s - %s 处理失败: %s", book1, book2, e)
+                failed.append((book1, book2))
+    return failed
+
+
+def main(args):
+    METRICS.record('Import', IMPORT_START, IMPORT_TIME, 'io')
+    logger.info("模块导入耗时 %.2fs", IMPORT_TIME)
+    set_embedding_backend(EmbeddingBackend[args.embedding.upper()])
+    # 解析与翻译电子书的同时在后台加载模型
+    warm_up()
+    align_mode = AlignMode[args.align_mode.upper()]
+    match_mode = MatchMode[args.match_mode.upper()]
+    match_algorithm = MatchAlgorithm[args.match_algorithm.upper()]
+    if args.translator != 'pygtrans':
+        set_translator(TranslatorType[args.translator.upper()])
+
+    if args.manifest:
+        failed = run_batch(read_manifest(args.manifest), workers=args.workers, load=args.load,
+                           parse_workers=args.parse_workers, align_mode=align_mode, match_mode=match_mode,
+                           match_algorithm=match_algorithm, stream=args.stream,
+                           sentence_align=args.sentence_align, align_workers=args.align_workers)
+        for book1, book2 in failed:
+            logger.warning("处理失败: %s - %s", book1, book2)
+        return
 
     if type(args.book) == list and len(args.book) > 2:
-        logger.warning("一次只能解析两本电子书。")
-        exit()
+        logger.warning("一次只能解析两本电子书，多对电子书请使用 --manifest。")
+        return
     elif len(args.book) < 2:
         logger.warning("请同时输入中文与英文两本电子书。")
-        exit()
+        return
 
     book1, book2 = args.book
     preview = args.preview
     load = args.load
 
-    book_en = Book.open_book(book1, load=load, debug=False)
-    book_zn = Book.open_book(book2, load=load)
+    book_en, book_zn = prepare_pair(book1, book2, load=load, parse_workers=args.parse_workers, match_mode=match_mode)
+    align_pair(book_en, book_zn, load=load, preview=preview, align_mode=align_mode, match_mode=match_mode,
+               match_algorithm=match_algorithm, stream=args.stream, sentence_align=args.sentence_align,
+               align_workers=args.align_workers)
 
-    book_en.get_translate()
 
-    matcher = PageMatcher.open_matcher(book_en, book_zn, load=load)
-    matcher.check_page_num()
-    book_en, book_zn = matcher.get_books()
-    matcher.match()
-    aligner = Aligner()
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='manual to this script')
+    parser.add_argument('book', metavar='book', type=str, nargs='*', help='电子书所在文件，请放在epubs文件夹内',
+                        default=['book1.epub', 'book2.epub'])
+    parser.add_argument('--preview', type=bool, default=True, help='是否打开预览功能，会在每个章节对齐后展示对齐内容, 默认开启')
+    parser.add_argument('--load', type=bool, default=True, help='是否加载本地保存的内容，继续执行任务，默认开启')
+    parser.add_argument('--parse_workers', type=int, default=1, help='解析章节使用的进程数量，默认1')
+    parser.add_argument('--align_mode', type=str, default='window', choices=['window', 'matrix'],
+                        help='段落对齐算法，window为滑动窗口，matrix为整章相似度矩阵+动态规划，默认window')
+    parser.add_argument('--align_workers', type=int, default=1,
+                        help='段落对齐使用的进程数量，大于1时主进程负责模型计算，各章节在进程池中并行对齐，默认1')
+    parser.add_argument('--match_mode', type=str, default='translate', choices=['translate', 'direct'],
+                        help='章节匹配方式，translate为先翻译再匹配，direct为直接比较英文与中文，只翻译匹配不上的章节，默认translate')
+    parser.add_argument('--match_algorithm', type=str, default='greedy', choices=['greedy', 'global'],
+                        help='章节匹配算法，greedy为逐章三轮匹配，global为整体相似度矩阵+长度先验的最大权二分匹配，默认greedy')
+    parser.add_argument('--stream', action='store_true',
+                        help='流式输出，每个章节对齐后立即写入 书名_combined 文件夹（章节html与chapters.jsonl），最后仍会生成合并的epub')
+    parser.add_argument('--sentence_align', action='store_true',
+                        help='在对齐的段落内部继续进行句子对齐，结果写入流式输出的chapters.jsonl，会自动开启--stream')
+    parser.add_argument('--manifest', type=str, default=None, help='批量任务清单文件，每行为一对电子书：英文版 中文版')
+    parser.add_argument('--workers', type=int, default=2, help='批量模式下同时解析与翻译的电子书对数，默认2')
+    parser.add_argument('--trace', type=str, default=None,
+                        help='保存Chrome trace格式的耗时记录，同时在同名_summary.json中保存耗时与计数汇总')
+    parser.add_argument('--translator', type=str, default='pygtrans', choices=['pygtrans', 'azure', 'local', 'http'],
+                        help='翻译后端，local为本地Marian模型，http为translate_server.py等本地翻译服务，默认pygtrans')
+    parser.add_argument('--embedding', type=str, default='torch', choices=['torch', 'onnx'],
+                        help='文本相似度模型的推理后端，onnx为int8量化的ONNX模型，需要先运行 onnx_embedding.py --export，默认torch')
+    parser.add_argument('--profile', type=str, default=None, help='使用cProfile分析运行过程，结果保存到该文件')
 
-    for page1, page2, _ in matcher.matched_pages[:]:
-        # page1.reset()
-        if not page1.is_aligned:
-            aligner.align(page1, page2)
-            if preview:
-                page1.print_page_combined()
-    book_en.save_combined()
+    args = parser.parse_args()
+    with profile(args.profile) if args.profile else nullcontext():
+        main(args)
     print_time_log()
+    if args.trace:
+        METRICS.export_trace(args.trace)
+        METRICS.export_json(os.path.splitext(args.trace)[0] + '_summary.json')
@@ -2,10 +2,11 @@
 
 from book import *
 import pickle
+import numpy as np
 from settings import *
+from embedding import EmbeddingStore, get_sim_model, text_digest, MODEL_NAME
+from vector_index import build_index
 
-# 文本相似度对比模型，在Comparator第一次使用时初始化
-sim_model = None
 TEMP_SAVE_DIR = "temp"
 
 # 段落对齐相似度要求
@@ -14,25 +15,113 @@ ALIGN_THRESHOLD = 0.7
 PAGE_MATCH_FIRST_THRESHOLD = 0.8
 # 第二轮章节匹配加入备选项要求
 PAGE_MATCH_SECOND_THRESHOLD = 0.7
+# 是否批量计算文本向量，关闭后退回逐对调用模型的方式
+EMBEDDING_BATCH = True
+# 中文章节数量达到该值时，章节匹配改为从摘要向量索引中查询备选章节
+PAGE_INDEX_MIN_PAGES = 200
+# 从索引中查询的备选章节数量
+PAGE_MATCH_TOP_K = 10
+# 矩阵对齐模式下，匹配成功的段落比例低于该值时，视为对齐出现问题
+ALIGN_MIN_MATCH_RATIO = 0.2
+# 直接用英文摘要与中文摘要匹配时的要求，跨语言的相似度整体偏低
+PAGE_MATCH_DIRECT_FIRST_THRESHOLD = 0.75
+PAGE_MATCH_DIRECT_SECOND_THRESHOLD = 0.6
+# 全局匹配时的长度先验：两章占全书长度的百分比每相差1，匹配分数扣除该值
+PAGE_MATCH_LENGTH_PENALTY = 0.02
+
+
+class AlignMode(Enum):
+    WINDOW = 1  # 滑动窗口逐段匹配
+    MATRIX = 2  # 整章相似度矩阵 + 带状动态规划
+
+
+class MatchMode(Enum):
+    TRANSLATE = 1  # 先翻译英文章节，再与中文章节匹配
+    DIRECT = 2  # 多语言模型直接比较英文与中文，匹配不上的章节再翻译后匹配
+
+
+class MatchAlgorithm(Enum):
+    GREEDY = 1  # 按长度顺序逐章寻找，三轮匹配
+    GLOBAL = 2  # 整体相似度矩阵 + 长度先验，求最大权二分匹配
+
+
+def banded_alignment(scores, band):
+    """
+    在相似度矩阵上求单调对齐，每个右侧段落分配给一个左侧段落，分配位置随右侧段落顺序单调不减，
+    目标为所有分配的相似度之和最大。只在按两章段落数比例缩放后的对角线附近 band 宽度内搜索
+    :param scores: (左侧段落数, 右侧段落数) 的相似度矩阵
+    :param band: 对角线两侧的搜索宽度
+    :return: 长度为右侧段落数的数组，表示每个右侧段落对应的左侧段落下标
+    """
+    n_left, n_right = scores.shape
+    rows = np.arange(n_left)
+    centers = np.arange(n_right) * (n_left / n_right)
+    in_band = np.abs(rows[:, None] - centers[None, :]) <= band
+
+    back = np.zeros((n_right, n_left), dtype=np.int32)
+    total = np.where(in_band[:, 0], scores[:, 0], -np.inf)
+    for j in range(1, n_right):
+        # 前缀最大值及其位置：左侧位置不超过 i 的最优路径
+        best = np.maximum.accumulate(total)
+        back[j] = np.maximum.accumulate(np.where(total == best, rows, 0))
+        total = np.where(in_band[:, j], best + scores[:, j], -np.inf)
+
+    assignment = np.zeros(n_right, dtype=np.int32)
+    assignment[-1] = int(np.argmax(total))
+    for j in range(n_right - 1, 0, -1):
+        assignment[j - 1] = back[j][assignment[j]]
+    return assignment
+
+
+def align_chapter(aligner, name, shape, start, n_left, n_right):
+    """
+    子进程中对齐一个章节，从共享内存中读取主进程写入的段落向量，只返回对齐结果
+    :param aligner: Aligner，提供对齐模式与窗口参数
+    :param name: 共享内存名称
+    :param shape: 共享内存中向量矩阵的形状，所有章节的段落向量依次排列
+    :param start: 本章向量的起始行，之后n_left行为英文段落，再之后n_right行为中文段落
+    :param n_left: 英文段落数
+    :param n_right: 中文段落数
+    :return: (assignments, bad)
+    """
+    from multiprocessing import shared_memory
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        vectors = np.ndarray(shape, dtype=np.float32, buffer=shm.buf)
+        result = aligner.solve(vectors[start: start + n_left], vectors[start + n_left: start + n_left + n_right])
+        del vectors
+    finally:
+        shm.close()
+    return result
 
 
 class Comparator:
     """
     文本相似度对比工具
+    batch模式下，每段文本只编码一次，归一化后的向量保存在矩阵中，相似度即为向量点积
     """
 
-    def __init__(self):
+    def __init__(self, batch=EMBEDDING_BATCH):
         # 文本相似度对比缓存
         self.cache = {}
+        self.batch = batch
+        self.embeddings = EmbeddingStore() if batch else None
 
         # 初次使用时初始化
-        global sim_model
-        if sim_model is None:
-            from text2vec import Similarity, EmbeddingType, SimilarityType
-            sim_model = Similarity(model_name_or_path='sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2')
-            # from similarities.fastsim import HnswlibSimilarity 
-            # sim_model = HnswlibSimilarity(
-            # model_name_or_path='sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2')
+        self.sim_model = get_sim_model()
+        # from similarities.fastsim import HnswlibSimilarity
+        # sim_model = HnswlibSimilarity(
+        # model_name_or_path='sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2')
+
+    def encode(self, texts):
+        """
+        批量编码一组文本，之后的相似度计算直接使用缓存的向量
+        :param texts: 文本列表
+        :return: 归一化的向量矩阵
+        """
+        if not self.batch:
+            return None
+        return self.embeddings.encode(list(texts))
 
     def compare_sentence(self, sentence1, sentence2):
         """
@@ -41,12 +130,39 @@ class Comparator:
         :param sentence2: 
         :return: 
         """
-        if not self.cache.get((sentence1, sentence2)):
-            score = sim_model.get_score(sentence1, sentence2)
+        if self.batch:
+            vectors = self.embeddings.encode([sentence1, sentence2])
+            return float(vectors[0] @ vectors[1])
+        key = (text_digest(sentence1), text_digest(sentence2))
+        if not self.cache.get(key):
+            incr('comparator_cache_misses')
+            with span('Model_Score', 'model'):
+                score = self.sim_model.get_score(sentence1, sentence2)
             # score = sim_model.similarity(sentence1, sentence2)
 
-            self.cache[(sentence1, sentence2)] = score
-        return self.cache[(sentence1, sentence2)]
+            self.cache[key] = score
+        else:
+            incr('comparator_cache_hits')
+        return self.cache[key]
+
+    def compare_matrix(self, sentences_left, sentences_right):
+        """
+        一次性计算两组文本之间的相似度矩阵
+        :param sentences_left: 
+        :param sentences_right: 
+        :return: (len(sentences_left), len(sentences_right)) 的相似度矩阵
+        """
+        if self.batch:
+            return self.encode(sentences_left) @ self.encode(sentences_right).T
+        return np.array([[self.compare_sentence(s1, s2) for s2 in sentences_right] for s1 in sentences_left])
+
+    def flush(self):
+        """
+        把新计算的向量写入磁盘缓存，下次运行或重新对齐时不必再次计算
+        :return:
+        """
+        if self.batch:
+            self.embeddings.flush()
 
 
 class Aligner:
@@ -54,15 +170,157 @@ class Aligner:
     段落对齐工具
     """
 
-    def __init__(self):
+    def __init__(self, mode=AlignMode.WINDOW):
         self.default_window_size = 2
         self.max_window_size = 10
-        pass
+        self.mode = mode
+
+    def get_align_key(self, page_right):
+        """
+        对齐结果所依赖的内容与参数，与保存的不一致时需要重新对齐
+        :param page_right: 中文章节
+        :return: (书名, 章节名, 章节指纹, 对齐参数)
+        """
+        params = (self.mode.name, ALIGN_THRESHOLD, ALIGN_MIN_MATCH_RATIO, self.default_window_size,
+                  self.max_window_size, MODEL_NAME)
+        return page_right.book.filename, page_right.name, page_right.fingerprint, params
 
     @time_log("Align_Pages")
     def align(self, page_left, page_right):
         """
-        段落对齐的算法主体，page_left为英文段落，page_right为中文段落
+        根据对齐模式选择对齐算法
+        :param page_left: 英文章节
+        :param page_right: 中文章节
+        :return:
+        """
+        logger.info("正在对齐章节 %s, %s", page_left.name, page_right.name)
+        page_left.align_key = self.get_align_key(page_right)
+        comparator = Comparator()
+        left_paragraphs, right_paragraphs = Aligner.get_paragraphs(page_left, page_right)
+
+        # 整章段落一次性批量编码
+        comparator.encode([_.text for _ in left_paragraphs + right_paragraphs])
+        if self.mode == AlignMode.MATRIX:
+            scores = None
+            if len(left_paragraphs) > 0 and len(right_paragraphs) > 0:
+                scores = comparator.compare_matrix([_.text for _ in left_paragraphs],
+                                                   [_.text for _ in right_paragraphs])
+            result = self.align_matrix(scores)
+        else:
+            result = self.align_window(
+                len(left_paragraphs), len(right_paragraphs),
+                lambda i, j: comparator.compare_sentence(left_paragraphs[i].text, right_paragraphs[j].text),
+                description=f"正在对齐章节{page_left.name}的段落")
+        comparator.flush()
+        self.apply(page_left, page_right, left_paragraphs, right_paragraphs, result)
+
+    @staticmethod
+    def get_paragraphs(page_left, page_right):
+        """
+        剔除无效段落
+        :return: (英文段落, 中文段落)
+        """
+        return [_ for _ in page_left.paragraphs if len(_.text) > 1], [_ for _ in page_right.paragraphs if len(_.text) > 1]
+
+    def apply(self, page_left, page_right, left_paragraphs, right_paragraphs, result):
+        """
+        把对齐结果写入英文章节并保存
+        :param result: align_window 或 align_matrix 的结果
+        :return:
+        """
+        assignments, bad = result
+        for right, left, score in assignments:
+            p_left = left_paragraphs[left]
+            p_left.add_subject(right_paragraphs[right], p_left.align_score if score is None else score)
+        if bad:
+            page_left.bad_aligned = True
+            logger.warning(f"章节{page_left.name} - {page_right.name} 段落对齐可能出现问题， 选择跳过该章节")
+        else:
+            page_left.is_aligned = True
+        page_left.save()
+
+    def solve(self, left_vectors, right_vectors):
+        """
+        只根据两章段落的向量求对齐结果，不接触章节对象，多进程对齐时在子进程中调用
+        :param left_vectors: 英文段落的归一化向量
+        :param right_vectors: 中文段落的归一化向量
+        :return: (assignments, bad)
+        """
+        if self.mode == AlignMode.MATRIX:
+            scores = None
+            if len(left_vectors) > 0 and len(right_vectors) > 0:
+                scores = left_vectors @ right_vectors.T
+            return self.align_matrix(scores)
+        return self.align_window(len(left_vectors), len(right_vectors),
+                                 lambda i, j: float(left_vectors[i] @ right_vectors[j]), progress=False)
+
+    def align_parallel(self, pairs, workers):
+        """
+        多进程逐章对齐。主进程是唯一加载模型的进程，先把所有章节的段落一次性批量编码，只写一次向量缓存，
+        向量写入共享内存后，各章节的对齐求解分配到子进程中；结果按章节顺序写回英文章节
+        :param pairs: [(英文章节, 中文章节)...]
+        :param workers: 子进程数量
+        :return: 按pairs的顺序生成 (英文章节, 中文章节)
+        """
+        # 逐对调用模型时没有可以共享的向量，退回单进程对齐
+        if workers <= 1 or not EMBEDDING_BATCH:
+            for page_left, page_right in pairs:
+                self.align(page_left, page_right)
+                yield page_left, page_right
+            return
+        pairs = list(pairs)
+        if len(pairs) == 0:
+            return
+
+        from concurrent.futures import ProcessPoolExecutor
+        from multiprocessing import get_context, shared_memory
+
+        # 所有章节的段落一起编码，模型按批次连续计算，不同章节中重复的段落只编码一次
+        chapters = [Aligner.get_paragraphs(page_left, page_right) for page_left, page_right in pairs]
+        comparator = Comparator()
+        with span('Align_Encode', 'stage', chapters=len(chapters)):
+            vectors = comparator.encode([_.text for left, right in chapters for _ in left + right])
+        comparator.flush()
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        del comparator
+
+        shm = shared_memory.SharedMemory(create=True, size=max(vectors.nbytes, 1))
+        pending = []  # (英文章节, 中文章节, 英文段落, 中文段落, future)
+        # 模型与多线程不能安全地fork，子进程使用spawn启动
+        executor = ProcessPoolExecutor(max_workers=workers, mp_context=get_context('spawn'))
+        try:
+            np.ndarray(vectors.shape, dtype=np.float32, buffer=shm.buf)[:] = vectors
+            start = 0
+            for (page_left, page_right), (left, right) in zip(pairs, chapters):
+                future = executor.submit(align_chapter, self, shm.name, vectors.shape, start, len(left), len(right))
+                pending.append((page_left, page_right, left, right, future))
+                start += len(left) + len(right)
+            del vectors
+            while pending:
+                yield self.merge(*pending.pop(0))
+        finally:
+            for _ in pending:
+                _[-1].cancel()
+            executor.shutdown(wait=True)
+            shm.close()
+            shm.unlink()
+
+    def merge(self, page_left, page_right, left_paragraphs, right_paragraphs, future):
+        """
+        等待子进程的对齐结果并写回英文章节
+        :return: (英文章节, 中文章节)
+        """
+        with span('Align_Wait', 'stage'):
+            result = future.result()
+        logger.info("章节 %s, %s 对齐完成", page_left.name, page_right.name)
+        page_left.align_key = self.get_align_key(page_right)
+        self.apply(page_left, page_right, left_paragraphs, right_paragraphs, result)
+        incr('align_parallel_pages')
+        return page_left, page_right
+
+    def align_window(self, n_left, n_right, score, description='', progress=True):
+        """
+        段落对齐的算法主体，left为英文段落，right为中文段落
         left 与 right 是滑动窗口的两个指针
         每次选择right指向的right_paragraph, 并维持一个以left指向的left_paragraph为中心构成的滑动窗口，与窗口内的文本进行相似度匹配
         找到匹配度足够高的段落就放到它的后面，表明匹配成功
@@ -71,93 +329,130 @@ class Aligner:
         直到下次匹配成功时，一起放到left_paragraph后面
 
         如果持续找不到合适的匹配段落(window_size>20 超过10次)，则会启用兜底方案，遍历全文，为当前段落寻找匹配内容
-        :param page_left: 英文章节
-        :param page_right: 中文章节
-        :return: 
+        :param n_left: 英文段落数
+        :param n_right: 中文段落数
+        :param score: score(i, j) 第i个英文段落与第j个中文段落的相似度
+        :param description: 进度条说明
+        :param progress: 是否显示进度条
+        :return: (assignments, bad)，assignments为按顺序添加的 [(中文段落下标, 英文段落下标, 分数)...]
         """
-        logger.info("正在对齐章节 %s, %s", page_left.name, page_right.name)
-        comparator = Comparator()
-        left_paragraphs = page_left.paragraphs
-        right_paragraphs = page_right.paragraphs
-
-        # 剔除无效段落
-        left_paragraphs = [_ for _ in left_paragraphs if len(_.text) > 1]
-        right_paragraphs = [_ for _ in right_paragraphs if len(_.text) > 1]
-
-        left_dict = {}
-        for index, p in enumerate(left_paragraphs):
-            left_dict[p] = index
-
+        assignments = []
         unassigned_paragraph = []
 
         left = 0  # 当前left_paragraph位置
         right = 0  # 当前right_paragraph位置
         stuck_times = 0  # 匹配卡住的次数
 
-        with tqdm(total=len(right_paragraphs)) as bar:
-            bar.set_description(f"正在对齐章节{page_left.name}的段落")
-            while right < len(right_paragraphs) and left < len(left_paragraphs):
+        with tqdm(total=n_right, disable=not progress) as bar:
+            bar.set_description(description)
+            while right < n_right and left < n_left:
                 is_match = False
-                p_right = right_paragraphs[right]
 
                 # 滑动窗口大小 = 默认窗口大小 + 堆积未分配的unassigned_paragraph的长度*2
                 if stuck_times < 10:
                     window_size = min(self.default_window_size + 1 + len(unassigned_paragraph) * 2,
                                       self.max_window_size)
                 else:  # 如果卡住超过 10 次，自动进入全文搜索阶段，window_size放到最大
-                    window_size = int(len(left_paragraphs) / 2)
-                potential_p_list = left_paragraphs[
-                                   left: min(left + window_size, len(left_paragraphs))] + left_paragraphs[max(0,
-                                                                                                              left - window_size): left]
+                    window_size = int(n_left / 2)
+                potential_p_list = list(range(left, min(left + window_size, n_left))) + list(
+                    range(max(0, left - window_size), left))
 
-                for i, p_left in enumerate(potential_p_list):
-                    score = comparator.compare_sentence(p_left.text, p_right.text)
+                for p_left in potential_p_list:
+                    s = score(p_left, right)
                     # 相似度超过threshold标记为匹配成功
-                    if score >= ALIGN_THRESHOLD:
+                    if s >= ALIGN_THRESHOLD:
                         # 清空unassigned_paragraph, 和当前匹配到的段落放在一起
                         while len(unassigned_paragraph) > 0:
-                            _ = unassigned_paragraph.pop(0)
-                            left_paragraphs[max(0, left_dict[p_left] - 1)].add_subject(_)
+                            assignments.append((unassigned_paragraph.pop(0), max(0, p_left - 1), 0))
                         # 把中文段落加到英文段落后面
-                        p_left.add_subject(p_right, score)
+                        assignments.append((right, p_left, s))
                         right += 1
-                        left = left_dict[p_left] + 1
+                        left = p_left + 1
                         is_match = True
                         stuck_times = 0
                         break
 
                 if not is_match:
-                    unassigned_paragraph.append(p_right)
+                    unassigned_paragraph.append(right)
                     right += 1
                     if window_size >= self.max_window_size:
                         stuck_times += 1
                     # 全文搜索之后仍然出现长时间卡住的情况，标记为 对齐出现了重大问题
                     if stuck_times > 20:
-                        page_left.bad_aligned = True
-                        logger.warning(f"章节{page1.name} - {page2.name} 段落对齐可能出现问题， 选择跳过该章节")
-                        return
+                        return assignments, True
 
                 bar.update(1)
 
         # 如果仍有剩余或未匹配成功的中文段落，全都加到最后
-        if len(unassigned_paragraph) > 0:
-            for _ in unassigned_paragraph:
-                left_paragraphs[min(left, len(left_paragraphs) - 1)].add_subject(_)
+        for _ in unassigned_paragraph:
+            assignments.append((_, min(left, n_left - 1), 0))
+        for _ in range(right, n_right):
+            assignments.append((_, n_left - 1, 0))
+        return assignments, False
 
-        for _ in right_paragraphs[right:]:
-            left_paragraphs[-1].add_subject(_)
+    def align_matrix(self, scores):
+        """
+        矩阵对齐算法，一次性计算整章 英文段落 x 中文段落 的相似度矩阵，
+        再用带状动态规划求出单调的对齐结果，计算量只与两章段落数有关，不会因为匹配困难而退化
 
-        page_left.is_aligned = True
-        page_left.save()
+        相似度超过ALIGN_THRESHOLD的中文段落视为匹配成功，其余段落跟随动态规划分配到的英文段落
+        :param scores: (英文段落数, 中文段落数) 的相似度矩阵，任意一方没有段落时为None
+        :return: (assignments, bad)，分数为None表示沿用英文段落当前的分数
+        """
+        if scores is None:
+            return [], False
+        n_left, n_right = scores.shape
+        band = max(self.max_window_size, n_left // 10)
+        assignment = banded_alignment(scores, band)
+        matched_scores = scores[assignment, np.arange(n_right)]
+
+        if np.mean(matched_scores >= ALIGN_THRESHOLD) < ALIGN_MIN_MATCH_RATIO:
+            return [], True
+        return [(right, int(left), float(score) if score >= ALIGN_THRESHOLD else None)
+                for right, (left, score) in enumerate(zip(assignment, matched_scores))], False
+
+    @time_log("Align_Sentences")
+    def align_sentences(self, page_left):
+        """
+        在已经对齐的段落内部进行句子对齐：整章句子一次性批量编码，
+        每个英文段落只与其对应的中文段落的句子组成小矩阵，用带状动态规划求单调对齐，计算量与段落对齐相当
+        :param page_left: 已经对齐的英文章节
+        :return: [(英文段落, [(英文句子, [(中文句子, 分数)...])...])...]，只包含有对应中文段落的段落
+        """
+        blocks = []
+        for p in page_left.paragraphs:
+            subjects = p.subjects
+            if len(subjects) == 0:
+                continue
+            left = p.extract_sentences()
+            right = [s for sub_p in subjects for s in sub_p.extract_sentences()]
+            if left and right:
+                blocks.append((p, left, right))
+        if len(blocks) == 0:
+            return []
+
+        comparator = Comparator()
+        comparator.encode([s.text for _, left, right in blocks for s in left + right])
+        result = []
+        for p, left, right in blocks:
+            scores = comparator.compare_matrix([_.text for _ in left], [_.text for _ in right])
+            assignment = banded_alignment(scores, max(len(left), len(right)))
+            pairs = [(s, []) for s in left]
+            for j, i in enumerate(assignment):
+                pairs[i][1].append((right[j], float(scores[i, j])))
+            result.append((p, pairs))
+        comparator.flush()
+        return result
 
 
 class PageMatcher:
-    def __init__(self, book_left, book_right):
+    def __init__(self, book_left, book_right, mode=MatchMode.TRANSLATE, algorithm=MatchAlgorithm.GREEDY):
         self.pages_left = list(sorted(book_left.pages[:], key=lambda x: x.get_length(), reverse=True))
         self.pages_right = list(sorted(book_right.pages[:], key=lambda x: x.get_length(), reverse=True))
-        self.book_length_left = book_left.get_length()
-        self.book_length_right = book_right.get_length()
         self.filename = PageMatcher.get_filename(book_left, book_right)
+        self.mode = mode
+        self.algorithm = algorithm
+        self.params = PageMatcher.get_params(mode, algorithm)
 
         self.matched_pages = []
         self.unmatched_pages = self.pages_left[:]
@@ -166,86 +461,277 @@ class PageMatcher:
     @time_log("Match_Pages")
     def match(self):
         """
-        章节匹配算法的主体，left为英文版本，right为中文版，三轮匹配
-        第一轮，根据left文本长度，选出合适的right备选章节，相似度>0.8直接返回
-        第二轮，扩大备选章节数量，相似度大于0.8直接返回
-        第三轮，如果以上两轮找不到的话，选择大于0.7且分数最高的章节作为匹配结果
+        章节匹配的主体。TRANSLATE模式下用翻译后的英文摘要匹配，
+        DIRECT模式下先直接用英文摘要匹配，只有匹配不上的章节才翻译后再匹配一次
         :return:
         """
+        if self.finished:
+            return
         comparator = Comparator()
 
-        if self.finished:
+        if self.mode == MatchMode.DIRECT:
+            book_left = self.get_books()[0]
+            paragraphs, requests = book_left.count_translate_requests(book_left.pages)
+            self.match_pages(comparator, translated=False)
+            fallback = self.unmatched_pages[:]
+            fallback_paragraphs, fallback_requests = book_left.count_translate_requests(fallback)
+            if fallback:
+                logger.info("%d 个章节无法直接匹配，翻译后重新匹配", len(fallback))
+                book_left.translate_pages(fallback)
+                self.match_pages(comparator, translated=True)
+            incr('translate_avoided_paragraphs', paragraphs - fallback_paragraphs)
+            incr('translate_avoided_requests', requests - fallback_requests)
+            logger.info("直接匹配省去翻译 %d 段，%d 次翻译请求", paragraphs - fallback_paragraphs,
+                        requests - fallback_requests)
+        else:
+            self.match_pages(comparator, translated=True)
+
+        for page in self.unmatched_pages:
+            logger.info("Matched Page not Found for page %s (body_end=%d): %s ", page.name, page.body_end,
+                        page.get_abstract()[:50])
+        comparator.flush()
+        self.save()
+        self.finished = True
+
+    def match_pages(self, comparator, translated=True):
+        """
+        为尚未匹配的英文章节寻找中文章节
+        :param comparator:
+        :param translated: True则使用翻译后的英文摘要，False则直接使用英文摘要，阈值相应降低
+        :return:
+        """
+        if self.algorithm == MatchAlgorithm.GLOBAL:
+            self.match_pages_global(comparator, translated)
+        else:
+            self.match_pages_greedy(comparator, translated)
+
+    def match_pages_global(self, comparator, translated=True):
+        """
+        全局匹配，一次性计算 未匹配英文章节 x 未匹配中文章节 的摘要相似度矩阵，
+        减去两章长度占比之差作为长度先验后，用匈牙利算法求最大权二分匹配，结果与章节的遍历顺序无关。
+        相似度低于第二轮阈值的组合不参与匹配
+        :param comparator:
+        :param translated: True则使用翻译后的英文摘要，False则直接使用英文摘要，阈值相应降低
+        :return:
+        """
+        threshold = PAGE_MATCH_SECOND_THRESHOLD if translated else PAGE_MATCH_DIRECT_SECOND_THRESHOLD
+        pages_left, pages_right = self.unmatched_pages, self.pages_right
+        if len(pages_left) == 0 or len(pages_right) == 0:
             return
+        abstracts_left = [_.get_abstract(translated=translated) for _ in pages_left]
+        abstracts_first = [_.get_abstract() for _ in pages_right]
+        abstracts_second = [_.get_abstract(n=15) for _ in pages_right]
+
+        if comparator.batch and len(pages_right) >= PAGE_INDEX_MIN_PAGES:
+            # 章节较多时只计算索引中最相近的k个章节，其余位置视为不匹配，得到稀疏的相似度矩阵
+            vectors_left = comparator.encode(abstracts_left)
+            scores = np.zeros((len(pages_left), len(pages_right)), dtype=np.float32)
+            for abstracts in (abstracts_first, abstracts_second):
+                index = build_index(comparator.encode(abstracts))
+                for i, vector in enumerate(vectors_left):
+                    ids, values = index.query(vector, PAGE_MATCH_TOP_K)
+                    scores[i, ids] = np.maximum(scores[i, ids], values)
+        else:
+            scores = np.maximum(comparator.compare_matrix(abstracts_left, abstracts_first),
+                                comparator.compare_matrix(abstracts_left, abstracts_second))
+
+        percent_left = np.array([_.stats.percent for _ in pages_left])
+        percent_right = np.array([_.stats.percent for _ in pages_right])
+        weights = scores - PAGE_MATCH_LENGTH_PENALTY * np.abs(percent_left[:, None] - percent_right[None, :])
+        weights[(scores < threshold) | (weights <= 0)] = 0
+
+        # scipy.optimize 导入较慢，只在使用全局匹配时导入
+        from scipy.optimize import linear_sum_assignment
+        matched_left, matched_right = set(), set()
+        for i, j in zip(*linear_sum_assignment(weights, maximize=True)):
+            if weights[i, j] > 0:
+                self.matched_pages.append((pages_left[i], pages_right[j], float(scores[i, j])))
+                matched_left.add(pages_left[i])
+                matched_right.add(pages_right[j])
+        self.unmatched_pages = [_ for _ in pages_left if _ not in matched_left]
+        self.pages_right = [_ for _ in pages_right if _ not in matched_right]
+
+    def match_pages_greedy(self, comparator, translated=True):
+        """
+        为尚未匹配的英文章节寻找中文章节，三轮匹配
+        第一轮，根据left文本长度，选出合适的right备选章节，相似度>0.8直接返回
+        第二轮，扩大备选章节数量，相似度大于0.8直接返回
+        第三轮，如果以上两轮找不到的话，选择大于0.7且分数最高的章节作为匹配结果
+        :param comparator:
+        :param translated: True则使用翻译后的英文摘要，False则直接使用英文摘要，阈值相应降低
+        :return:
+        """
+        if translated:
+            first_threshold, second_threshold = PAGE_MATCH_FIRST_THRESHOLD, PAGE_MATCH_SECOND_THRESHOLD
+        else:
+            first_threshold, second_threshold = PAGE_MATCH_DIRECT_FIRST_THRESHOLD, PAGE_MATCH_DIRECT_SECOND_THRESHOLD
 
         pages_left = self.unmatched_pages[:]
         matched_pages_candidates = []
+
+        # 所有章节摘要一次性批量编码
+        comparator.encode([_.get_abstract(translated=translated) for _ in pages_left] +
+                          [_.get_abstract() for _ in self.pages_right] +
+                          [_.get_abstract(n=15) for _ in self.pages_right])
+
+        # 中文章节较多时，为摘要向量建立近似最近邻索引，只在最相近的k个章节中按长度筛选，避免逐一比较
+        # 逐对调用模型时没有摘要向量，仍然逐一比较
+        index_pages = index_first = index_second = None
+        # 用集合记录匹配情况，全部匹配完成后再按原顺序重建未匹配列表，避免在循环中逐个从列表删除
+        available = set(self.pages_right)
+        matched_left = set()
+        lookup = self.build_length_lookup()
+        if comparator.batch and len(self.pages_right) >= PAGE_INDEX_MIN_PAGES:
+            index_pages = self.pages_right[:]
+            index_first = build_index(comparator.encode([_.get_abstract() for _ in index_pages]))
+            index_second = build_index(comparator.encode([_.get_abstract(n=15) for _ in index_pages]))
+
         for page_left in pages_left:
-            potential_pages = self.get_potential_pages(page_left)
-            abstract_left = page_left.get_abstract(translated=True)
+            abstract_left = page_left.get_abstract(translated=translated)
+            candidates = self.query_index(index_first, index_pages, available, abstract_left, comparator)
+            potential_pages = self.get_potential_pages(page_left, candidates=candidates, lookup=lookup,
+                                                       available=available)
             is_match = False
 
             # 第一轮相似度大于0.8直接返回
             for page_right in potential_pages:
                 abstract_right = page_right.get_abstract()
                 score = comparator.compare_sentence(abstract_left, abstract_right)
-                if score >= PAGE_MATCH_FIRST_THRESHOLD:
+                if score >= first_threshold:
                     self.matched_pages.append((page_left, page_right, score))
-                    self.pages_right.remove(page_right)
-                    self.unmatched_pages.remove(page_left)
+                    matched_left.add(page_left)
+                    available.discard(page_right)
                     is_match = True
                     break
 
             # 第二轮，扩大搜索范围
             if not is_match:
-                potential_pages = self.get_potential_pages(page_left, search_range=100)
+                candidates = self.query_index(index_second, index_pages, available, abstract_left, comparator)
+                potential_pages = self.get_potential_pages(page_left, search_range=100, candidates=candidates,
+                                                           lookup=lookup, available=available)
                 for page_right in potential_pages:
                     abstract_right = page_right.get_abstract(n=15)
                     score = comparator.compare_sentence(abstract_left, abstract_right)
                     # 相似度大于0.8直接返回
-                    if score >= PAGE_MATCH_FIRST_THRESHOLD:
+                    if score >= first_threshold:
                         self.matched_pages.append((page_left, page_right, score))
-                        self.pages_right.remove(page_right)
-                        self.unmatched_pages.remove(page_left)
+                        matched_left.add(page_left)
+                        available.discard(page_right)
                         is_match = True
                         break
                     # 相似度 > 0.7 后放入备选列表
-                    elif score >= PAGE_MATCH_SECOND_THRESHOLD:
+                    elif score >= second_threshold:
                         matched_pages_candidates.append((page_left, page_right, score))
 
         # 第三轮，把备选列表按照分数进行排序，选出分数较高的部分
         matched_pages_candidates = sorted(matched_pages_candidates, key=lambda x: x[2], reverse=True)
         for page_left, page_right, score in matched_pages_candidates:
-            if page_left in self.unmatched_pages and page_right in self.pages_right:
+            if page_left not in matched_left and page_right in available:
                 self.matched_pages.append((page_left, page_right, score))
-                self.pages_right.remove(page_right)
-                self.unmatched_pages.remove(page_left)
+                matched_left.add(page_left)
+                available.discard(page_right)
+        self.unmatched_pages = [_ for _ in pages_left if _ not in matched_left]
+        self.pages_right = [_ for _ in self.pages_right if _ in available]
 
-        for page in self.unmatched_pages:
-            logger.info("Matched Page not Found for page %s (body_end=%d): %s ", page.name, page.body_end,
-                        page.get_abstract()[:50])
-        self.save()
-        self.finished = True
+    def build_length_lookup(self):
+        """
+        把未匹配的中文章节按长度占比从大到小排成数组，查找长度接近的章节时二分查找
+        :return: (章节列表, 负的长度占比数组，升序)
+        """
+        pages = self.pages_right[:]
+        return pages, -np.array([_.stats.percent for _ in pages])
 
-    def get_potential_pages(self, left_page, search_range=0.75):
+    def get_potential_pages(self, left_page, search_range=0.75, candidates=None, lookup=None, available=None):
         """
         根据英文章节的长度，选择长度接近的中文章节
         :param left_page: 英文章节
         :param search_range: 长度范围
-        :return: [备选章节...]
+        :param candidates: 只在这些中文章节中筛选，默认为全部未匹配的中文章节
+        :param lookup: build_length_lookup的结果，传入时用二分查找代替逐一比较
+        :param available: 与lookup一起使用，尚未匹配的中文章节
+        :return: [备选章节...] 按长度从大到小排列
         """
-        left_page_percent = left_page.get_length() / self.book_length_left * 100
+        left_page_percent = left_page.stats.percent
         right_page_percent_min = left_page_percent - search_range
         right_page_percent_max = left_page_percent + search_range
+        if candidates is None and lookup is not None:
+            pages, neg_percents = lookup
+            start = np.searchsorted(neg_percents, -right_page_percent_max, side='right')
+            end = np.searchsorted(neg_percents, -right_page_percent_min, side='left')
+            return [_ for _ in pages[start:end] if _ in available]
         potential_pages = []
-        for page_right in self.pages_right:
-            page_right_percent = page_right.get_length() / self.book_length_right * 100
-            if right_page_percent_max > page_right_percent > right_page_percent_min:
+        for page_right in (self.pages_right if candidates is None else candidates):
+            if right_page_percent_max > page_right.stats.percent > right_page_percent_min:
                 potential_pages.append(page_right)
         return potential_pages
 
+    @staticmethod
+    def query_index(index, index_pages, available, abstract, comparator):
+        """
+        从摘要向量索引中查询与英文摘要最相近的中文章节
+        :param index: 向量索引，为None时表示不使用索引
+        :param index_pages: 索引id对应的中文章节
+        :param available: 尚未匹配的中文章节
+        :param abstract: 英文章节摘要（翻译后）
+        :param comparator:
+        :return: [备选章节...] 按相似度从高到低排列，不使用索引时返回None
+        """
+        if index is None:
+            return None
+        ids, _ = index.query(comparator.encode([abstract])[0], PAGE_MATCH_TOP_K)
+        return [index_pages[_] for _ in ids if index_pages[_] in available]
+
     def save(self):
-        with open(os.path.join(TEMP_SAVE_DIR, self.filename), 'wb') as f:
-            pickle.dump(self, f)
+        with span('Matcher_Save', 'io'):
+            data = pickle.dumps(self)
+            with open(os.path.join(TEMP_SAVE_DIR, self.filename), 'wb') as f:
+                f.write(data)
+        incr('pickle_bytes', len(data))
+
+    def __getstate__(self):
+        """
+        章节只保存名称与内容指纹，不把两本书一起保存，加载后通过bind重新关联
+        :return:
+        """
+        state = self.__dict__.copy()
+        state.pop('pages_left')
+        state.pop('pages_right')
+        state['unmatched_pages'] = [_.name for _ in self.unmatched_pages]
+        state['matched_pages'] = [(l.name, l.fingerprint, r.name, r.fingerprint, score)
+                                  for l, r, score in self.matched_pages]
+        state['right_pages'] = set((_.name, _.fingerprint) for _ in self.get_books()[1].pages)
+        return state
+
+    def bind(self, book_left, book_right):
+        """
+        把保存的章节名称重新关联到两本书的章节。
+        任意一方已经删除或内容发生变化的匹配结果作废，这些章节与新增的章节一起重新匹配，其余匹配结果沿用
+        :param book_left: 英文版
+        :param book_right: 中文版
+        :return:
+        """
+        left = {_.name: _ for _ in book_left.pages}
+        right = {_.name: _ for _ in book_right.pages}
+        matched_before = set(_[2] for _ in self.matched_pages)
+        self.matched_pages = [(left[l], right[r], score) for l, l_fp, r, r_fp, score in self.matched_pages
+                              if l in left and r in right and left[l].fingerprint == l_fp
+                              and right[r].fingerprint == r_fp]
+        matched_left = set(_[0] for _ in self.matched_pages)
+        matched_right = set(_[1] for _ in self.matched_pages)
+
+        self.pages_left = list(sorted(book_left.pages[:], key=lambda x: x.get_length(), reverse=True))
+        self.pages_right = [_ for _ in sorted(book_right.pages[:], key=lambda x: x.get_length(), reverse=True)
+                            if _ not in matched_right]
+        unmatched_before = set(self.unmatched_pages)
+        self.unmatched_pages = [_ for _ in self.pages_left if _ not in matched_left]
+        # 有新的英文章节需要匹配
+        if any(_.name not in unmatched_before for _ in self.unmatched_pages):
+            self.finished = False
+        # 中文版有新增或内容变化的章节，或者作废的匹配结果空出了中文章节，之前没有匹配上的英文章节也要重新匹配
+        right_before = getattr(self, 'right_pages', None)
+        if right_before is None or any((_.name, _.fingerprint) not in right_before or _.name in matched_before
+                                       for _ in self.pages_right):
+            self.finished = False
 
     def get_books(self):
         """
@@ -276,25 +762,40 @@ class PageMatcher:
                            f"{book_right.get_name()[:20]}主要章节数量:{right_page_num},"
                            f"请检查电子书资源或者版本是否正确。")
 
+    @staticmethod
+    def get_params(mode, algorithm):
+        """
+        :return: 影响章节匹配结果的参数，与保存的不一致时需要重新匹配
+        """
+        return (mode.name, algorithm.name, PAGE_MATCH_FIRST_THRESHOLD, PAGE_MATCH_SECOND_THRESHOLD,
+                PAGE_MATCH_DIRECT_FIRST_THRESHOLD, PAGE_MATCH_DIRECT_SECOND_THRESHOLD, PAGE_MATCH_LENGTH_PENALTY,
+                MODEL_NAME)
+
     @staticmethod
     def get_filename(book_left, book_right):
         return book_left.get_name() + '_' + book_right.get_name() + '.match'
 
     @staticmethod
-    def open_matcher(book1, book2, load=True):
+    def open_matcher(book1, book2, load=True, mode=MatchMode.TRANSLATE, algorithm=MatchAlgorithm.GREEDY):
         """
         读取或新建一个章节匹配器
         :param book1: 英文版
         :param book2: 中文版
         :param load: 是否加载已经保存的内容
+        :param mode: 章节匹配方式
+        :param algorithm: 章节匹配算法
         :return: 
         """
+        book1.link(book2)
         filename = PageMatcher.get_filename(book1, book2)
         if filename in os.listdir(TEMP_SAVE_DIR) and load:
             with open(os.path.join(TEMP_SAVE_DIR, filename), 'rb') as f:
-                return pickle.load(f)
-        else:
-            return PageMatcher(book1, book2)
+                matcher = pickle.load(f)
+            if getattr(matcher, 'params', None) == PageMatcher.get_params(mode, algorithm):
+                matcher.bind(book1, book2)
+                return matcher
+            logger.info("章节匹配参数发生变化，重新匹配")
+        return PageMatcher(book1, book2, mode=mode, algorithm=algorithm)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+
+import cProfile
+import collections
+import io
+import json
+import logging
+import os
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+
+# settings 会导入本模块，这里直接获取同名logger，避免循环导入
+logger = logging.getLogger('logger_name')
+
+# 最多保存的耗时区间数量，超出后只统计汇总数据，不再记录明细
+METRICS_MAX_EVENTS = 200000
+
+
+class Metrics:
+    """
+    运行过程中的耗时区间与计数器。耗时区间可以嵌套(书 -> 章节 -> 段落)，按线程与起止时间在trace中形成层级，
+    category 用于区分模型计算、网络请求与读写文件等不同类型的耗时
+    """
+
+    def __init__(self, max_events=METRICS_MAX_EVENTS):
+        self.max_events = max_events
+        self.lock = threading.Lock()
+        self.origin = time.perf_counter()
+        self.events = []  # (名称, 类型, 开始时间, 耗时, 线程id, 参数)
+        self.durations = collections.defaultdict(list)  # 名称 -> [耗时...]
+        self.categories = {}  # 名称 -> 类型
+        self.counters = collections.Counter()
+
+    @contextmanager
+    def span(self, name, category='stage', **args):
+        """
+        记录一段代码的耗时
+        :param name: 区间名称
+        :param category: 耗时类型: stage, model, network, io
+        :param args: 附加在trace中的参数
+        :return:
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, start, time.perf_counter() - start, category, **args)
+
+    def record(self, name, start, duration, category='stage', **args):
+        """
+        记录一段已经结束的耗时，用于无法用span包住的区间，例如程序启动时的模块导入
+        :param name: 区间名称
+        :param start: time.perf_counter() 的开始时间
+        :param duration: 耗时(s)
+        :param category: 耗时类型
+        :param args: 附加在trace中的参数
+        :return:
+        """
+        with self.lock:
+            self.durations[name].append(duration)
+            self.categories[name] = category
+            if len(self.events) < self.max_events:
+                self.events.append((name, category, start - self.origin, duration,
+                                    threading.get_ident(), args))
+
+    def incr(self, name, value=1):
+        """
+        计数器累加
+        :param name: 计数器名称
+        :param value: 增加的数量
+        :return:
+        """
+        with self.lock:
+            self.counters[name] += value
+
+    def summary(self):
+        """
+        按区间名称汇总耗时
+        :return: {名称: {category, count, total, mean, p50, p95, max}}
+        """
+        result = {}
+        with self.lock:
+            items = [(name, sorted(durations)) for name, durations in self.durations.items()]
+        for name, durations in items:
+            count = len(durations)
+            result[name] = {
+                'category': self.categories[name],
+                'count': count,
+                'total': sum(durations),
+                'mean': sum(durations) / count,
+                'p50': durations[int(0.5 * (count - 1))],
+                'p95': durations[int(0.95 * (count - 1))],
+                'max': durations[-1],
+            }
+        return result
+
+    def category_summary(self):
+        """
+        按耗时类型汇总，只统计最外层的区间，避免嵌套区间重复计算
+        :return: {类型: 总耗时}
+        """
+        totals = collections.defaultdict(float)
+        with self.lock:
+            events = sorted(self.events, key=lambda _: (_[4], _[2]))
+        ends = {}
+        for name, category, start, duration, tid, args in events:
+            # 同一线程、同一类型中被上一个区间包含的区间不再计入
+            key = (tid, category)
+            if start < ends.get(key, -1):
+                continue
+            ends[key] = start + duration
+            totals[category] += duration
+        return dict(totals)
+
+    def report(self):
+        """
+        输出耗时与计数器汇总
+        :return:
+        """
+        for name, stat in sorted(self.summary().items(), key=lambda _: -_[1]['total']):
+            logger.info("最终 %s 消耗时间: %.3fs, 次数: %d, 平均: %.4fs, p50: %.4fs, p95: %.4fs, 最长: %.4fs",
+                        name, stat['total'], stat['count'], stat['mean'], stat['p50'], stat['p95'], stat['max'])
+        for category, total in sorted(self.category_summary().items()):
+            logger.info("%s 类型总耗时: %.3fs", category, total)
+        for name, value in sorted(self.counters.items()):
+            logger.info("计数 %s: %s", name, value)
+
+    def export_json(self, filename):
+        """
+        导出汇总结果
+        :param filename:
+        :return:
+        """
+        with open(filename, 'w', encoding='utf-8') as f:
+            json.dump({'spans': self.summary(), 'categories': self.category_summary(),
+                       'counters': dict(self.counters)}, f, ensure_ascii=False, indent=2)
+
+    def export_trace(self, filename):
+        """
+        导出Chrome trace格式的文件，可以在 chrome://tracing 或 Perfetto 中查看
+        :param filename:
+        :return:
+        """
+        pid = os.getpid()
+        with self.lock:
+            events = list(self.events)
+            counters = dict(self.counters)
+        # 模块导入等区间早于本模块创建，整体平移使时间从0开始
+        offset = min([_[2] for _ in events] + [0])
+        trace = [{'name': name, 'cat': category, 'ph': 'X', 'ts': (start - offset) * 1e6, 'dur': duration * 1e6,
+                  'pid': pid, 'tid': tid, 'args': args}
+                 for name, category, start, duration, tid, args in events]
+        end = max([_[2] + _[3] for _ in events], default=0) - offset
+        trace.append({'name': 'counters', 'ph': 'C', 'ts': end * 1e6, 'pid': pid, 'args': counters})
+        with open(filename, 'w', encoding='utf-8') as f:
+            json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, f, ensure_ascii=False)
+        if len(self.events) >= self.max_events:
+            logger.warning("耗时区间超过 %d 个，trace中只包含前 %d 个", self.max_events, self.max_events)
+
+    def reset(self):
+        with self.lock:
+            self.origin = time.perf_counter()
+            self.events = []
+            self.durations = collections.defaultdict(list)
+            self.categories = {}
+            self.counters = collections.Counter()
+
+
+METRICS = Metrics()
+
+
+def span(name, category='stage', **args):
+    return METRICS.span(name, category, **args)
+
+
+def incr(name, value=1):
+    METRICS.incr(name, value)
+
+
+@contextmanager
+def profile(filename=None, top=30):
+    """
+    使用cProfile分析一段代码，输出耗时最多的函数
+    :param filename: 保存pstats结果的文件，可以用snakeviz等工具查看，为空时不保存
+    :param top: 日志中输出的函数数量
+    :return:
+    """
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        if filename:
+            profiler.dump_stats(filename)
+        stream = io.StringIO()
+        pstats.Stats(profiler, stream=stream).sort_stats('cumulative').print_stats(top)
+        logger.debug(stream.getvalue())
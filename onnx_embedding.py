@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import multiprocessing
+import os
+import time
+import numpy as np
+import embedding
+from embedding import MODEL_NAME, EmbeddingBackend, normalize
+from settings import *
+
+# 导出的ONNX模型与分词器保存的位置
+ONNX_MODEL_DIR = os.path.join('temp', 'models', MODEL_NAME.split('/')[-1] + '-onnx')
+ONNX_MODEL_FILE = 'model.onnx'
+ONNX_INT8_MODEL_FILE = 'model_int8.onnx'
+# 与 sentence-transformers 中该模型的设置相同，超出部分截断
+ONNX_MAX_SEQ_LENGTH = 128
+ONNX_OPSET = 14
+# 推理使用的线程数，为0时由onnxruntime决定
+ONNX_THREADS = 0
+# 与PyTorch模型相比，相似度允许的最大误差
+EMBEDDING_PARITY_TOLERANCE = 0.03
+# 一致性检查与性能测试时每个章节最多取的段落数
+PARITY_PARAGRAPHS = 40
+
+
+def export_model(model_name=MODEL_NAME, out_dir=ONNX_MODEL_DIR, quantize=True):
+    """
+    把Hugging Face上的模型导出为ONNX，并动态量化为int8，需要安装torch, transformers, onnx与onnxruntime
+    :param model_name: 模型名称
+    :param out_dir: 保存的位置，同时保存分词器
+    :param quantize: 是否生成int8量化的模型
+    :return: 导出的模型文件
+    """
+    import torch
+    from transformers import AutoModel, AutoTokenizer
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+
+    os.makedirs(out_dir, exist_ok=True)
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    model = AutoModel.from_pretrained(model_name).eval()
+    tokenizer.save_pretrained(out_dir)
+
+    inputs = tokenizer(['An example sentence.', '一个例句。'], padding=True, return_tensors='pt')
+    model_file = os.path.join(out_dir, ONNX_MODEL_FILE)
+    dynamic_axes = {'input_ids': {0: 'batch', 1: 'sequence'}, 'attention_mask': {0: 'batch', 1: 'sequence'},
+                    'last_hidden_state': {0: 'batch', 1: 'sequence'}}
+    with torch.no_grad():
+        torch.onnx.export(model, (inputs['input_ids'], inputs['attention_mask']), model_file,
+                          input_names=['input_ids', 'attention_mask'], output_names=['last_hidden_state'],
+                          dynamic_axes=dynamic_axes, opset_version=ONNX_OPSET, do_constant_folding=True)
+    logger.info("ONNX模型已导出到 %s，大小 %.1fMB", model_file, os.path.getsize(model_file) / 2 ** 20)
+    if not quantize:
+        return model_file
+
+    int8_file = os.path.join(out_dir, ONNX_INT8_MODEL_FILE)
+    quantize_dynamic(model_file, int8_file, weight_type=QuantType.QInt8)
+    logger.info("int8量化模型已保存到 %s，大小 %.1fMB", int8_file, os.path.getsize(int8_file) / 2 ** 20)
+    return int8_file
+
+
+class OnnxEncoder:
+    """
+    使用onnxruntime在CPU上推理的句向量模型，与text2vec的 SentenceModel.encode 接口相同，
+    输出为最后一层隐状态按attention mask求平均
+    """
+
+    def __init__(self, model_dir=ONNX_MODEL_DIR, model_file=ONNX_INT8_MODEL_FILE, threads=ONNX_THREADS):
+        try:
+            import onnxruntime
+            from tokenizers import Tokenizer
+        except ImportError as e:
+            raise ImportError(f"ONNX向量模型需要安装onnxruntime与tokenizers: {e}")
+        path = os.path.join(model_dir, model_file)
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"未找到ONNX模型 {path}，请先运行 python onnx_embedding.py --export")
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = threads
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, 'tokenizer.json'))
+        self.tokenizer.enable_truncation(ONNX_MAX_SEQ_LENGTH)
+        self.tokenizer.enable_padding(pad_id=self.tokenizer.token_to_id('<pad>') or 0)
+
+    def encode(self, texts, batch_size=64):
+        """
+        :param texts: 文本列表
+        :param batch_size: 每次推理的文本数量
+        :return: (len(texts), d) 的向量矩阵，未归一化
+        """
+        if isinstance(texts, str):
+            texts = [texts]
+        # 按长度排序后分批，减少每批中的padding
+        order = sorted(range(len(texts)), key=lambda _: len(texts[_]))
+        vectors = [None] * len(texts)
+        for start in range(0, len(order), batch_size):
+            batch = order[start: start + batch_size]
+            encodings = self.tokenizer.encode_batch([texts[_] for _ in batch])
+            input_ids = np.array([_.ids for _ in encodings], dtype=np.int64)
+            attention_mask = np.array([_.attention_mask for _ in encodings], dtype=np.int64)
+            hidden = self.session.run(None, {'input_ids': input_ids, 'attention_mask': attention_mask})[0]
+            mask = attention_mask[:, :, None].astype(np.float32)
+            pooled = (hidden * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+            for i, vector in zip(batch, pooled):
+                vectors[i] = vector
+        if not vectors:
+            return np.zeros((0, 0), dtype=np.float32)
+        return np.stack(vectors).astype(np.float32)
+
+
+class OnnxSimilarity:
+    """
+    与 text2vec.Similarity 接口相同的ONNX模型
+    """
+
+    def __init__(self, model_dir=ONNX_MODEL_DIR, model_file=ONNX_INT8_MODEL_FILE):
+        self.model = OnnxEncoder(model_dir, model_file)
+
+    def get_score(self, sentence1, sentence2):
+        vectors = normalize(self.model.encode([sentence1, sentence2]))
+        return float(vectors[0] @ vectors[1])
+
+
+def load_backend(backend):
+    """
+    :param backend: EmbeddingBackend
+    :return: 对应的相似度模型
+    """
+    embedding.set_embedding_backend(backend)
+    return embedding.get_sim_model()
+
+
+def sample_chapters(book_en, paragraphs=PARITY_PARAGRAPHS):
+    """
+    取已经对齐的章节对，每章最多取前若干段，用于比较两种模型的相似度矩阵
+    :return: [(英文段落文本, 中文段落文本)...]
+    """
+    chapters = []
+    for page in book_en.pages:
+        if not page.is_aligned or len(page.subject_pages) == 0:
+            continue
+        page_zn = page.subject_pages[0]
+        left = [_.text for _ in page.paragraphs if len(_.text) > 1][:paragraphs]
+        right = [_.text for _ in page_zn.paragraphs if len(_.text) > 1][:paragraphs]
+        if left and right:
+            chapters.append((left, right))
+    return chapters
+
+
+def compare_scores(reference, candidate, chapters):
+    """
+    比较两种模型在同一组章节上的段落相似度矩阵
+    :param reference: 作为基准的模型(PyTorch)
+    :param candidate: 待检查的模型(ONNX)
+    :param chapters: sample_chapters的结果
+    :return: {max_diff, mean_diff, flips: {阈值: 判断结果不同的比例}, argmax_agreement}
+    """
+    from match import (ALIGN_THRESHOLD, PAGE_MATCH_FIRST_THRESHOLD, PAGE_MATCH_SECOND_THRESHOLD,
+                       PAGE_MATCH_DIRECT_FIRST_THRESHOLD, PAGE_MATCH_DIRECT_SECOND_THRESHOLD)
+    thresholds = sorted({ALIGN_THRESHOLD, PAGE_MATCH_FIRST_THRESHOLD, PAGE_MATCH_SECOND_THRESHOLD,
+                         PAGE_MATCH_DIRECT_FIRST_THRESHOLD, PAGE_MATCH_DIRECT_SECOND_THRESHOLD})
+    diffs, flips, cells = [], {_: 0 for _ in thresholds}, 0
+    agree = rows = 0
+    for left, right in chapters:
+        scores = []
+        for model in (reference, candidate):
+            vectors = normalize(model.model.encode(left + right))
+            scores.append(vectors[:len(left)] @ vectors[len(left):].T)
+        diff = np.abs(scores[0] - scores[1])
+        diffs.append(diff.ravel())
+        cells += diff.size
+        for t in thresholds:
+            flips[t] += int(((scores[0] >= t) != (scores[1] >= t)).sum())
+        # 段落对齐时实际会被采用的组合：基准模型中超过对齐阈值的最相似段落
+        confident = scores[0].max(axis=1) >= ALIGN_THRESHOLD
+        rows += int(confident.sum())
+        agree += int((scores[0].argmax(axis=1) == scores[1].argmax(axis=1))[confident].sum())
+    diffs = np.concatenate(diffs) if diffs else np.zeros(1)
+    return {
+        'max_diff': float(diffs.max()),
+        'mean_diff': float(diffs.mean()),
+        'flips': {t: flips[t] / max(cells, 1) for t in thresholds},
+        'argmax_agreement': agree / rows if rows else 1.0,
+    }
+
+
+def check_parity(book1, book2, tolerance=EMBEDDING_PARITY_TOLERANCE):
+    """
+    检查int8 ONNX模型与PyTorch模型的相似度差异，需要两本书已经完成对齐
+    :param book1: 英文版文件名
+    :param book2: 中文版文件名
+    :param tolerance: 允许的最大相似度误差
+    :return: 是否通过
+    """
+    from book import Book
+    book_en = Book.open_book(book1)
+    book_en.link(Book.open_book(book2))
+    chapters = sample_chapters(book_en)
+    if not chapters:
+        logger.warning("%s 还没有对齐完成的章节，请先运行 main.py", book1)
+        return False
+    reference = load_backend(EmbeddingBackend.TORCH)
+    candidate = load_backend(EmbeddingBackend.ONNX)
+    result = compare_scores(reference, candidate, chapters)
+    logger.info("比较 %d 个章节: 最大误差 %.4f, 平均误差 %.4f, 最相似段落一致 %.1f%%", len(chapters),
+                result['max_diff'], result['mean_diff'], result['argmax_agreement'] * 100)
+    for threshold, rate in result['flips'].items():
+        logger.info("阈值 %.2f 两种模型判断不同的比例: %.3f%%", threshold, rate * 100)
+    passed = result['max_diff'] <= tolerance
+    if not passed:
+        logger.warning("ONNX模型相似度误差 %.4f 超过允许范围 %.4f", result['max_diff'], tolerance)
+    return passed
+
+
+def measure_backend(backend, texts, repeat, batch_size):
+    """
+    在子进程中运行，保证每种模型的内存占用单独统计
+    :return: (加载耗时, 段/s, 常驻内存峰值MB)
+    """
+    import resource
+    start = time.perf_counter()
+    model = load_backend(backend)
+    load_time = time.perf_counter() - start
+    model.model.encode(texts[:batch_size], batch_size=batch_size)
+    cost = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        model.model.encode(texts, batch_size=batch_size)
+        cost = min(cost, time.perf_counter() - start)
+    return load_time, len(texts) / cost, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def benchmark_backends(filenames, repeat=3, batch_size=embedding.EMBEDDING_BATCH_SIZE):
+    """
+    比较两种模型的加载耗时、编码速度与内存占用，每种模型在单独的进程中测试
+    :param filenames: epubs文件夹内的电子书
+    :param repeat: 重复次数，取最短耗时
+    :param batch_size:
+    :return: {模型: (加载耗时, 段/s, 内存峰值MB)}
+    """
+    from book import Book
+    texts = [p.text for filename in filenames for page in Book(filename, save=False).pages
+             for p in page.paragraphs[:PARITY_PARAGRAPHS] if len(p.text) > 1]
+    result = {}
+    context = multiprocessing.get_context('spawn')
+    for backend in EmbeddingBackend:
+        with context.Pool(1) as pool:
+            result[backend.name] = pool.apply(measure_backend, (backend, texts, repeat, batch_size))
+        load_time, speed, memory = result[backend.name]
+        logger.info("%s: 加载 %.2fs, %d 段, %.1f 段/s, 内存峰值 %.0fMB", backend.name, load_time, len(texts),
+                    speed, memory)
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='导出int8量化的ONNX向量模型，检查与PyTorch模型的一致性并测试速度')
+    parser.add_argument('book', metavar='book', type=str, nargs='*', help='电子书所在文件，请放在epubs文件夹内',
+                        default=['book1.epub', 'book2.epub'])
+    parser.add_argument('--export', action='store_true', help='导出并量化模型')
+    parser.add_argument('--parity', action='store_true', help='在已经对齐的两本书上比较两种模型的相似度')
+    parser.add_argument('--benchmark', action='store_true', help='比较两种模型的编码速度与内存占用')
+    parser.add_argument('--repeat', type=int, default=3, help='性能测试的重复次数')
+    args = parser.parse_args()
+
+    if args.export:
+        export_model()
+    if args.parity and not check_parity(*args.book[:2]):
+        exit(1)
+    if args.benchmark:
+        benchmark_backends(args.book)
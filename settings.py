@@ -4,7 +4,7 @@ from enum import Enum
 import colorlog
 from tqdm import tqdm
 from functools import wraps
-import collections
+from metrics import METRICS, span, incr, profile
 
 EPUB_DIR = 'epubs'
 
@@ -37,8 +37,8 @@ logger = logging.getLogger('logger_name')
 
 # 输出到控制台
 console_handler = logging.StreamHandler()
-# 输出到文件
-file_handler = logging.FileHandler(filename='test.log', mode='a', encoding='utf8')
+# 输出到文件，第一条日志写入时才打开文件
+file_handler = logging.FileHandler(filename='test.log', mode='a', encoding='utf8', delay=True)
 
 # 日志级别，logger 和 handler以最高级别为准，不同handler之间可以不一样，不相互影响
 logger.setLevel(logging.DEBUG)
@@ -69,31 +69,28 @@ if not logger.handlers:
 console_handler.close()
 file_handler.close()
 
-TIME_RECORDER = collections.defaultdict(list)
 
 
 def print_time_log():
-    for section in TIME_RECORDER:
-        logger.info("最终 {} 消耗时间: {}".format(section, sum(TIME_RECORDER[section])))
-        logger.debug(str(TIME_RECORDER[section]))
+    METRICS.report()
 
 
-def time_log(section, preview=True):
+def time_log(section, preview=True, category='stage'):
     """
-    记录每个阶段的运行时间
-    :param preview:
-    :param section:
+    记录每个阶段的运行时间，嵌套调用时形成层级关系，结果保存在 METRICS 中
+    :param preview: 是否在每次调用后输出该阶段累计耗时
+    :param section: 阶段名称
+    :param category: 耗时类型: stage, model, network, io
     :return:
     """
     def decorate(func):
         @wraps(func)
         def wrapper(*args, **kwargs):
-            start = time.time()
-            result = func(*args, **kwargs)
-            end = time.time()
-            TIME_RECORDER[section].append(end - start)
+            with span(section, category):
+                result = func(*args, **kwargs)
             if preview:
-                logger.debug("{} 消耗时间: {}".format(section, sum(TIME_RECORDER[section])))
+                logger.debug("{} 消耗时间: {}".format(section, sum(METRICS.durations[section])))
+            return result
         return wrapper
 
     return decorate
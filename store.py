@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+import os
+import pickle
+from settings import *
+
+
+class StateLog:
+    """
+    只追加写入的状态日志，每条记录单独pickle后追加到文件末尾，读取时按顺序重放
+    程序中途退出导致的残缺记录会在读取时被截掉
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def append(self, records):
+        """
+        追加一组记录
+        :param records: 可pickle的记录列表
+        :return: 写入的字节数
+        """
+        if len(records) == 0:
+            return 0
+        data = b''.join(pickle.dumps(_) for _ in records)
+        with open(self.filename, 'ab') as f:
+            f.write(data)
+        return len(data)
+
+    def replay(self):
+        """
+        读取全部完整的记录
+        :return: [记录...]
+        """
+        records = []
+        if not os.path.exists(self.filename):
+            return records
+        with open(self.filename, 'rb') as f:
+            valid_end = 0
+            while True:
+                try:
+                    records.append(pickle.load(f))
+                    valid_end = f.tell()
+                except EOFError:
+                    break
+                except Exception as e:
+                    logger.warning("%s 存在不完整的记录，已忽略: %s", self.filename, e)
+                    break
+        if valid_end < os.path.getsize(self.filename):
+            with open(self.filename, 'r+b') as f:
+                f.truncate(valid_end)
+        return records
+
+    def size(self):
+        return os.path.getsize(self.filename) if os.path.exists(self.filename) else 0
+
+    def clear(self):
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+from book import split_sentences
+
+
+class SplitSentencesTest(unittest.TestCase):
+
+    def test_split(self):
+        self.assertEqual(split_sentences('She walked home. It was late! Was it?'),
+                         ['She walked home.', 'It was late!', 'Was it?'])
+        self.assertEqual(split_sentences('我回家了。天很晚了！'), ['我回家了。', '天很晚了！'])
+
+    def test_abbreviations(self):
+        self.assertEqual(split_sentences('Mr. Smith left early. He came back.'),
+                         ['Mr. Smith left early.', 'He came back.'])
+        self.assertEqual(split_sentences('The U.S. policy changed. It worked.'),
+                         ['The U.S. policy changed.', 'It worked.'])
+        self.assertEqual(split_sentences('He moved to Washington, D.C. last year. Then he left.'),
+                         ['He moved to Washington, D.C. last year.', 'Then he left.'])
+
+
+if __name__ == '__main__':
+    unittest.main()
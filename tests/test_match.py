@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+import os
+import pickle
+import re
+import zipfile
+import pytest
+import benchmark
+from book import Book
+from main import align_pages
+from match import PageMatcher, Aligner, MatchAlgorithm
+from settings import EPUB_DIR
+
+SOURCE = os.path.abspath(os.path.join(EPUB_DIR, 'book1.epub'))
+# 假模型区分度有限，清空这一章后它不会被其他章节顶替，英文版的同名章节保持未匹配
+CHAPTER = 'xhtml/19_Chapter_12.xhtml'
+
+
+def write_copy(filename, chapter, clear):
+    """
+    复制一份电子书，clear为True时清空指定章节的文字，使其无法与原章节匹配
+    """
+    with zipfile.ZipFile(SOURCE) as src, zipfile.ZipFile(filename, 'w') as out:
+        for info in src.infolist():
+            data = src.read(info)
+            if clear and info.filename.endswith(chapter):
+                text = data.decode('utf-8')
+                text = re.sub(r'>[^<]+<', '><', text)
+                data = text.encode('utf-8')
+            out.writestr(info, data)
+
+
+@pytest.fixture
+def work_dir(tmp_path):
+    """
+    中英文同一本书自身配对，离线的假模型与ECHO翻译器即可完成章节匹配，结束后恢复原来的翻译器与模型
+    """
+    restore = benchmark.install_stubs(str(tmp_path / 'embeddings'))
+    yield str(tmp_path)
+    restore()
+
+
+@pytest.fixture
+def left(work_dir):
+    book = Book(SOURCE, save=False)
+    book.get_translate()
+    return book
+
+
+def match(work_dir, left, right, algorithm=MatchAlgorithm.GREEDY):
+    matcher = PageMatcher(left, right, algorithm=algorithm)
+    matcher.filename = os.path.join(work_dir, 'pair.match')
+    matcher.match()
+    return matcher
+
+
+def test_right_chapter_changed(work_dir, left):
+    filename = os.path.join(work_dir, 'right.epub')
+    write_copy(filename, CHAPTER, clear=True)
+    matcher = match(work_dir, left, Book(filename, save=False))
+    assert CHAPTER in [_.name for _ in matcher.unmatched_pages]
+    assert len(matcher.matched_pages) > 0
+
+    # 只有中文版的这一章发生变化，英文版不变
+    write_copy(filename, CHAPTER, clear=False)
+    right = Book(filename, save=False)
+    matcher = pickle.loads(pickle.dumps(matcher))
+    matcher.bind(left, right)
+    assert not matcher.finished
+    matcher.match()
+    pairs = [(l.name, r.name) for l, r, _ in matcher.matched_pages]
+    assert (CHAPTER, CHAPTER) in pairs
+
+
+def test_unchanged_books_stay_finished(work_dir, left):
+    matcher = match(work_dir, left, Book(SOURCE, save=False))
+    matcher = pickle.loads(pickle.dumps(matcher))
+    matcher.bind(left, Book(SOURCE, save=False))
+    assert matcher.finished
+
+
+def test_rematch_clears_old_alignment(work_dir, left):
+    href_table = left.get_href_table()
+    page = next(_ for _ in left.pages if _.name == CHAPTER)
+    original = page.get_page_combined(href_table)
+    aligner = Aligner()
+    for _ in align_pages(match(work_dir, left, Book(SOURCE, save=False)), aligner):
+        pass
+    assert page.is_aligned
+    assert page.get_page_combined(href_table) != original
+
+    # 匹配参数变化后新建的匹配器，中文版的这一章已经清空，英文版的同名章节不再有对应章节
+    filename = os.path.join(work_dir, 'right.epub')
+    write_copy(filename, CHAPTER, clear=True)
+    matcher = match(work_dir, left, Book(filename, save=False), algorithm=MatchAlgorithm.GLOBAL)
+    assert page not in [_[0] for _ in matcher.matched_pages]
+    for _ in align_pages(matcher, aligner):
+        pass
+    assert not page.is_aligned
+    assert page.get_page_combined(href_table) == original
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+from translator import classify_text, TranslateAction
+
+
+class ClassifyTextTest(unittest.TestCase):
+
+    def test_copy(self):
+        for text in ['12', '- 34 -', 'XIV', 'IV.', 'MCMXCIV', 'https://example.com/a', 'someone@example.com',
+                     'ISBN 978-0-7352-2370-3 (hardcover)', '* * *', '第一章 开始']:
+            self.assertEqual(classify_text(text), TranslateAction.COPY, text)
+
+    def test_words_are_not_roman_numerals(self):
+        for text in ['Mild.', 'Did', 'mix', 'Civic', 'Vivid', 'Lid.', 'did.', 'civil', 'Dim.', 'MILD', 'Lied.']:
+            self.assertNotEqual(classify_text(text), TranslateAction.COPY, text)
+
+    def test_translate(self):
+        self.assertEqual(classify_text('She walked home alone that night.'), TranslateAction.TRANSLATE)
+
+    def test_other_scripts_are_translated(self):
+        for text in ['Я помню тот вечер очень хорошо.', 'Γνῶθι σεαυτόν, είπε ο δάσκαλος.',
+                     'السلام عليكم ورحمة الله.']:
+            self.assertEqual(classify_text(text), TranslateAction.TRANSLATE, text)
+
+
+if __name__ == '__main__':
+    unittest.main()
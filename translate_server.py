@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from translator import create_backend, TranslationError
+from settings import *
+
+
+class TranslateHandler(BaseHTTPRequestHandler):
+    """
+    POST /translate，请求 {"texts": [...]}，返回 {"translations": [...], "backend": 后端的缓存键}
+    客户端用backend区分不同服务的翻译缓存，为null时客户端不缓存结果
+    """
+
+    def do_POST(self):
+        if self.path != '/translate':
+            self.send_error(404)
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            texts = body['texts']
+        except Exception as e:
+            self.send_error(400, str(e))
+            return
+        try:
+            with self.server.lock:
+                translations = self.server.backend.translate_batch(texts) if texts else []
+        except TranslationError as e:
+            self.send_error(502, str(e))
+            return
+        data = json.dumps({'translations': translations, 'backend': self.server.backend.cache_key()},
+                          ensure_ascii=False).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, fmt, *args):
+        logger.debug(fmt, *args)
+
+
+def create_server(backend='ECHO', host='127.0.0.1', port=8765):
+    """
+    创建翻译服务，所有请求共用同一个翻译后端，模型只加载一次
+    :param backend: 翻译后端名称，默认原样返回文本，用于测试
+    :param host:
+    :param port: 为0时自动选择空闲端口
+    :return: ThreadingHTTPServer，调用 serve_forever() 开始服务
+    """
+    server = ThreadingHTTPServer((host, port), TranslateHandler)
+    server.backend = create_backend(backend)
+    server.backend.load()
+    # 本地模型一次只处理一批文本
+    server.lock = threading.Lock()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='本地翻译服务，可以作为 --translator http 的翻译后端')
+    parser.add_argument('--backend', type=str, default='LOCAL', help='翻译后端: LOCAL, ECHO, PYGTRANS, AZURE')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    args = parser.parse_args()
+
+    server = create_server(args.backend.upper(), args.host, args.port)
+    logger.info("翻译服务已启动: http://%s:%d/translate, 后端: %s", args.host, server.server_address[1], args.backend)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
@@ -1,7 +1,12 @@
-import requests, uuid, json
-from langdetect import detect
+import uuid
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from enum import Enum
-from pygtrans import Translate
 from settings import *
 
 # Add your key and endpoint
@@ -9,35 +14,305 @@ KEY = "************"
 ENDPOINT = "https://api.cognitive.microsofttranslator.com/"
 LOCATION = "eastus"
 
+# 同时进行的翻译请求数量
+TRANSLATE_WORKERS = 4
+# 每次请求最多打包的段落数量与字符数量
+TRANSLATE_BATCH_SIZE = 20
+TRANSLATE_BATCH_CHARS = 5000
+# 请求失败后的重试次数与初始等待时间(s)，每次重试等待时间翻倍
+TRANSLATE_MAX_RETRIES = 3
+TRANSLATE_BACKOFF = 1.0
+# 翻译缓存数据库，所有书共享
+TRANSLATION_CACHE_FILE = os.path.join('temp', 'translations.db')
+
+
+# 不需要翻译、原样保留的段落：页码与编号、罗马数字、网址、邮箱、ISBN、纯符号
+# 罗马数字只接受大写且符合书写规则的形式，避免把 Mild、Did、Civic 等普通单词当作编号
+ROMAN_PATTERN = r'(?-i:(?=[MDCLXVI])M{0,3}(?:CM|CD|D?C{0,3})(?:XC|XL|L?X{0,3})(?:IX|IV|V?I{0,3})\.?)'
+COPY_PATTERN = re.compile(r'^(?:[\d\s.,:;/\-–—()#]+|' + ROMAN_PATTERN +
+                          r'|(?:https?://|www\.)\S+|[\w.+-]+@[\w-]+\.[\w.]+'
+                          r'|isbn[\s:\-\dx]+(?:\([^)]*\))?|[\W_]+)$', re.I)
+CJK_PATTERN = re.compile(r'[\u3400-\u9fff\uf900-\ufaff]')
+# 汉字占全部文字(str.isalpha)的比例达到该值时，视为已经是中文
+TRANSLATE_CJK_RATIO = 0.5
+# 不超过该词数、每个词首字母大写且没有句末标点的片段视为人名或标题，暂不翻译
+DEFER_MAX_WORDS = 3
+
+
+class TranslateAction(Enum):
+    TRANSLATE = 1  # 请求翻译
+    COPY = 2  # 不需要翻译，译文即为原文
+    DEFER = 3  # 人名、标题等短片段，批量翻译时跳过，暂用原文，需要时再单独翻译
+
+
+def classify_text(text):
+    """
+    翻译前的快速筛选：先用正则与字符类别比例判断，只有中英文混杂的文本才调用langdetect
+    :param text:
+    :return: TranslateAction
+    """
+    text = text.strip()
+    if len(text) < 2 or COPY_PATTERN.match(text):
+        return TranslateAction.COPY
+    # 没有任何文字的片段原样保留；汉字占比足够高时视为中文，西里尔、希腊、阿拉伯等其他文字仍然需要翻译
+    letters = sum(1 for _ in text if _.isalpha())
+    cjk = len(CJK_PATTERN.findall(text))
+    if letters == 0 or cjk / letters >= TRANSLATE_CJK_RATIO:
+        return TranslateAction.COPY
+    words = text.split()
+    if len(words) <= DEFER_MAX_WORDS and text[-1] not in '.!?' and all(_[0].isupper() for _ in words if _[0].isalpha()):
+        return TranslateAction.DEFER
+    if cjk > 0:
+        from langdetect import detect
+        try:
+            if detect(text).startswith('zh'):
+                return TranslateAction.COPY
+        except Exception:
+            pass
+    return TranslateAction.TRANSLATE
+
 
 class TranslatorType(Enum):
     PYGTRANS = 1  # PYGTRANS的翻译API，免费，不太稳定，勉强可用
     AZURE = 2  # AZURE的翻译API，需要自己提供secret key
+    LOCAL = 3  # 本地的Marian翻译模型，使用CTranslate2推理，无需联网
+    HTTP = 4  # 本地或内网的翻译服务，接口见 translate_server.py
 
 
-class Translator:
+# 本地翻译模型：Hugging Face上的Marian模型名称，以及用 ct2-transformers-converter 转换后的CTranslate2模型位置
+LOCAL_TRANSLATE_MODEL = 'Helsinki-NLP/opus-mt-en-zh'
+LOCAL_TRANSLATE_CT2_DIR = os.path.join('temp', 'models', 'opus-mt-en-zh-ct2')
+# 翻译服务的地址与请求超时时间(s)
+HTTP_TRANSLATE_URL = 'http://127.0.0.1:8765/translate'
+HTTP_TRANSLATE_TIMEOUT = 60
+
+# 翻译后端名称 -> 后端类，可以通过 register_backend 在运行时增加
+TRANSLATION_BACKENDS = {}
+rate_limiters = {}
+
+
+class TranslationError(Exception):
+    pass
+
+
+class RateLimiter:
+    """
+    限制每秒请求数量，多个线程共享同一个限流器
+    """
+
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self.next_time = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.time()
+            wait = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+
+def get_rate_limiter(name, rate):
+    """
+    同一个翻译后端共享一个限流器
+    :param name: 后端名称
+    :param rate: 每秒最多发出的请求数量，为空时不限流
+    :return:
+    """
+    if name not in rate_limiters:
+        rate_limiters[name] = RateLimiter(rate)
+    return rate_limiters[name]
+
+
+def split_batches(texts, batch_size=TRANSLATE_BATCH_SIZE, batch_chars=TRANSLATE_BATCH_CHARS):
+    """
+    把文本按数量与字符数打包，每个包对应一次请求
+    :param texts:
+    :param batch_size: 每包最多的文本数量
+    :param batch_chars: 每包最多的字符数量，单段超出时单独成包
+    :return: [[文本下标...]...]
+    """
+    batches = []
+    batch, chars = [], 0
+    for i, text in enumerate(texts):
+        if batch and (len(batch) >= batch_size or chars + len(text) > batch_chars):
+            batches.append(batch)
+            batch, chars = [], 0
+        batch.append(i)
+        chars += len(text)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def text_hash(text):
+    return hashlib.sha1(text.encode('utf-8')).digest()
+
+
+class TranslationCache:
     """
-    翻译器主体，调用api翻译文本，考虑未来支持更多api
+    翻译结果缓存，按 (翻译API, 源语言, 目标语言, 文本摘要) 保存在本地SQLite数据库中，
+    同一段文本无论来自哪本书、哪个版本，都只需要请求一次翻译API
     """
-    def __init__(self, t=TranslatorType.PYGTRANS):
+
+    def __init__(self, filename=TRANSLATION_CACHE_FILE):
+        self.filename = filename
+        self.conn = None
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def connect(self):
+        """
+        初次使用时打开数据库，使用WAL模式，读写互不阻塞
+        :return:
+        """
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.filename, check_same_thread=False)
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS translations ('
+                              'backend TEXT, source TEXT, target TEXT, digest BLOB, translation TEXT, '
+                              'PRIMARY KEY (backend, source, target, digest)) WITHOUT ROWID')
+            self.conn.commit()
+        return self.conn
+
+    def get_many(self, backend, source, target, texts):
+        """
+        :return: {文本下标: 翻译}，只包含命中的部分
+        """
+        digests = [text_hash(_) for _ in texts]
+        found = {}
+        with self.lock:
+            conn = self.connect()
+            for start in range(0, len(digests), 500):
+                chunk = digests[start: start + 500]
+                rows = conn.execute('SELECT digest, translation FROM translations '
+                                    'WHERE backend=? AND source=? AND target=? AND digest IN (%s)'
+                                    % ','.join('?' * len(chunk)), [backend, source, target] + chunk)
+                found.update(rows)
+            result = {i: found[digest] for i, digest in enumerate(digests) if digest in found}
+            self.hits += len(result)
+            self.misses += len(texts) - len(result)
+        incr('translation_cache_hits', len(result))
+        incr('translation_cache_misses', len(texts) - len(result))
+        return result
+
+    def put_many(self, backend, source, target, texts, translations):
+        with self.lock:
+            conn = self.connect()
+            conn.executemany('INSERT OR REPLACE INTO translations VALUES (?, ?, ?, ?, ?)',
+                             [(backend, source, target, text_hash(text), translation)
+                              for text, translation in zip(texts, translations) if translation])
+            conn.commit()
+
+
+def register_backend(name, backend=None):
+    """
+    注册翻译后端，可以直接调用，也可以作为类装饰器使用
+    :param name: 后端名称，TranslatorType中的类型使用同名后端
+    :param backend: TranslationBackend 的子类
+    :return:
+    """
+    def decorate(cls):
+        TRANSLATION_BACKENDS[name] = cls
+        cls.name = name
+        return cls
+
+    if backend is None:
+        return decorate
+    return decorate(backend)
+
+
+def create_backend(t):
+    """
+    :param t: TranslatorType 或 已注册的后端名称
+    :return: TranslationBackend
+    """
+    name = t.name if isinstance(t, TranslatorType) else t
+    if name not in TRANSLATION_BACKENDS:
+        raise ValueError("UnRecognized Translator Type! %s" % name)
+    return TRANSLATION_BACKENDS[name]()
+
+
+class TranslationBackend:
+    """
+    翻译后端的基类，一次翻译一组文本。
+    rate_limit 为每秒最多发出的请求数量，batch_size 与 batch_chars 为每次请求最多打包的文本数量与字符数量，
+    max_workers 为同时进行的请求数量上限，为空时使用调用方指定的数量，category 为耗时统计中的类型
+    """
+    name = None
+    source = 'en'
+    target = 'zh'
+    rate_limit = None
+    batch_size = TRANSLATE_BATCH_SIZE
+    batch_chars = TRANSLATE_BATCH_CHARS
+    max_workers = None
+    category = 'network'
+
+    def load(self):
+        """
+        加载模型等耗时的准备工作，第一次翻译前调用
+        :return:
+        """
+        pass
+
+    def translate_batch(self, texts):
+        """
+        :param texts: 文本列表
+        :return: 与texts一一对应的翻译列表，失败时抛出TranslationError
+        """
+        raise NotImplementedError
+
+    def cache_key(self):
+        """
+        翻译缓存中区分后端的键，键相同的后端可以共用缓存的翻译
+        :return: 为None时不使用翻译缓存
+        """
+        return self.name
+
+
+@register_backend(TranslatorType.PYGTRANS.name)
+class PygtransBackend(TranslationBackend):
+    source = 'auto'
+    target = 'zh-CN'
+    rate_limit = 5
+
+    def __init__(self):
+        from pygtrans import Translate
+        self.client = Translate()
+
+    def translate_batch(self, texts):
+        response = self.client.translate(texts)
+        try:
+            return [_.translatedText for _ in response]
+        except Exception as e:
+            response = response.response
+            raise TranslationError(f"Translate By Pygtrans ErrorCode: {response.status_code} Error: {e}")
+
+
+@register_backend(TranslatorType.AZURE.name)
+class AzureBackend(TranslationBackend):
+    source = 'en'
+    target = 'zh-Hans'
+    rate_limit = 10
+
+    def __init__(self):
         path = '/translate'
         self.constructed_url = ENDPOINT + path
-        self.t = t
-        if self.t == TranslatorType.PYGTRANS:
-            self.client = Translate()
 
-    def translate_by_azure_api(self, text, from_l='en', to='zh-Hans'):
+    def translate_batch(self, texts):
         """
-        调用AZURE API接口，返回中文翻译
-        :param text: 文本内容 
-        :param from_l: 源文本语言
-        :param to: 目标翻译语言
-        :return: 翻译内容字符串
+        调用AZURE API接口，一次请求翻译多段文本，返回中文翻译
+        :param texts: 文本内容列表
+        :return: 翻译内容字符串列表
         """
         params = {
             'api-version': '3.0',
-            'from': from_l,
-            'to': [to]
+            'from': self.source,
+            'to': [self.target]
         }
 
         headers = {
@@ -50,34 +325,247 @@ class Translator:
         # You can pass more than one object in body.
         body = [{
             'text': text
-        }]
+        } for text in texts]
 
+        import requests
         request = requests.post(self.constructed_url, params=params, headers=headers, json=body)
         try:
             response = request.json()
+            # print(json.dumps(response, sort_keys=True, ensure_ascii=False, indent=4, separators=(',', ': ')))
+            return [_['translations'][0]['text'] for _ in response]
         except Exception as e:
-            logger.warning("Translation Error! %s", e)
-            return ""
-        # print(json.dumps(response, sort_keys=True, ensure_ascii=False, indent=4, separators=(',', ': ')))
-        return response[0]['translations'][0]['text']
+            raise TranslationError(f"Translate By Azure ErrorCode: {request.status_code} Error: {e}")
 
-    def translate(self, text):
-        if self.t == TranslatorType.AZURE:
-            return self.translate_by_azure_api(text)
-        elif self.t == TranslatorType.PYGTRANS:
-            return self.translate_by_pygtrans(text)
-        else:
-            logger.error("UnRecognized Translator Type! %s", self.t)
-            return ""
-
-    def translate_by_pygtrans(self, text):
-        response = self.client.translate(text)
+
+@register_backend(TranslatorType.LOCAL.name)
+class LocalBackend(TranslationBackend):
+    """
+    本地Marian翻译模型，第一次翻译时加载，之后一直保留在内存中。
+    存在转换好的CTranslate2模型时使用CTranslate2的int8推理，否则使用transformers直接推理。
+    模型本身按批处理，不需要限流，也不需要多个线程同时请求
+    """
+    rate_limit = None
+    batch_size = 32
+    batch_chars = 20000
+    max_workers = 1
+    category = 'model'
+
+    def __init__(self, model_name=LOCAL_TRANSLATE_MODEL, ct2_dir=LOCAL_TRANSLATE_CT2_DIR):
+        self.model_name = model_name
+        self.ct2_dir = ct2_dir
+        self.tokenizer = None
+        self.model = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        with self.lock:
+            if self.model is not None:
+                return
+            try:
+                from transformers import AutoTokenizer
+            except ImportError as e:
+                raise TranslationError(f"本地翻译需要安装transformers: {e}")
+            self.tokenizer = AutoTokenizer.from_pretrained(self.model_name)
+            try:
+                import ctranslate2
+            except ImportError:
+                ctranslate2 = None
+            if ctranslate2 is not None and os.path.isdir(self.ct2_dir):
+                self.model = ctranslate2.Translator(self.ct2_dir, device='cpu', compute_type='int8')
+            else:
+                from transformers import MarianMTModel
+                logger.info("未找到CTranslate2模型 %s，使用transformers推理", self.ct2_dir)
+                self.model = MarianMTModel.from_pretrained(self.model_name).eval()
+            logger.info("本地翻译模型 %s 加载完成", self.model_name)
+
+    def cache_key(self):
+        return '%s:%s' % (self.name, self.model_name)
+
+    def translate_batch(self, texts):
+        self.load()
+        if hasattr(self.model, 'translate_batch'):
+            tokens = [self.tokenizer.convert_ids_to_tokens(self.tokenizer.encode(_)) for _ in texts]
+            results = self.model.translate_batch(tokens, max_batch_size=self.batch_size, beam_size=2)
+            return [self.tokenizer.decode(self.tokenizer.convert_tokens_to_ids(_.hypotheses[0]),
+                                          skip_special_tokens=True) for _ in results]
+        import torch
+        inputs = self.tokenizer(texts, return_tensors='pt', padding=True, truncation=True)
+        with torch.no_grad():
+            outputs = self.model.generate(**inputs, num_beams=2)
+        return self.tokenizer.batch_decode(outputs, skip_special_tokens=True)
+
+
+@register_backend(TranslatorType.HTTP.name)
+class HttpBackend(TranslationBackend):
+    """
+    通过HTTP调用翻译服务，请求 {"texts": [...], "source": ..., "target": ...}，返回 {"translations": [...]}
+    """
+    rate_limit = None
+    batch_size = 32
+    batch_chars = 20000
+
+    def __init__(self, url=HTTP_TRANSLATE_URL):
+        import requests
+        self.url = url
+        self.session = requests.Session()
+        self.remote_key = None
+
+    def cache_key(self):
+        """
+        不同地址、不同后端或模型的翻译服务分开缓存，服务使用ECHO等不应缓存的后端时不使用缓存
+        :return:
+        """
+        if self.remote_key is None:
+            try:
+                response = self.session.post(self.url, json={'texts': []}, timeout=HTTP_TRANSLATE_TIMEOUT)
+                self.remote_key = response.json().get('backend') or ''
+            except Exception as e:
+                logger.warning("无法获取翻译服务 %s 使用的后端，本次不使用翻译缓存: %s", self.url, e)
+                return None
+        if not self.remote_key:
+            return None
+        return '%s:%s:%s' % (self.name, self.url, self.remote_key)
+
+    def translate_batch(self, texts):
+        request = self.session.post(self.url, json={'texts': texts, 'source': self.source, 'target': self.target},
+                                    timeout=HTTP_TRANSLATE_TIMEOUT)
         try:
-            return response.translatedText
+            translations = request.json()['translations']
         except Exception as e:
-            response = response.response
-            logger.warning("Translate By Pygtrans ErrorCode: %s Error: %s", response.status_code, e)
-            return ""
+            raise TranslationError(f"Translate By HTTP ErrorCode: {request.status_code} Error: {e}")
+        if len(translations) != len(texts):
+            raise TranslationError(f"Translate By HTTP Error: {len(texts)} texts, {len(translations)} translations")
+        return translations
+
+
+@register_backend('ECHO')
+class EchoBackend(TranslationBackend):
+    """
+    原样返回文本，用于离线测试
+    """
+    batch_size = 100
+    batch_chars = 100000
+    category = 'stage'
+
+    def translate_batch(self, texts):
+        return list(texts)
+
+    def cache_key(self):
+        # 原文不是翻译，不能写入缓存
+        return None
+
+
+class Translator:
+    """
+    翻译器主体，把文本打包后交给翻译后端，负责缓存、限流、重试与并发
+    """
+    def __init__(self, t=TranslatorType.PYGTRANS, cache=True):
+        """
+        :param t: TranslatorType 或 已注册的后端名称
+        :param cache: 是否使用翻译缓存
+        """
+        self.t = t
+        self.backend = create_backend(t)
+        self.from_l, self.to = self.backend.source, self.backend.target
+        self.rate_limiter = get_rate_limiter(self.backend.name, self.backend.rate_limit)
+        self.cache = TranslationCache() if cache else None
+
+    def get_cache_key(self):
+        """
+        :return: 翻译缓存中使用的后端键，不使用缓存时为None
+        """
+        if self.cache is None:
+            return None
+        return self.backend.cache_key()
+
+    def translate(self, text):
+        """
+        :param text:
+        :return: 翻译，重试次数用完仍然失败时返回None
+        """
+        return self.translate_batch([text])[0]
+
+    def detect_before_translate(self, text):
+        """
+        先检测语言，已经是中文的文本直接返回，避免无意义的翻译请求
+        翻译缓存只在translate中查询一次，命中与未命中的计数不会重复
+        :param text:
+        :return:
+        """
+        if classify_text(text) == TranslateAction.COPY:
+            return text
+        return self.translate(text)
+
+    def translate_batch(self, texts):
+        """
+        翻译多段文本，先查询翻译缓存，其余文本一次请求翻译完成，结果写入缓存
+        :param texts: 文本列表
+        :return: 与texts一一对应的翻译列表，请求失败的文本为None
+        """
+        key = self.get_cache_key()
+        if key is None:
+            return self.request_batch(texts)
+
+        translations = [""] * len(texts)
+        cached = self.cache.get_many(key, self.from_l, self.to, texts)
+        for i, translation in cached.items():
+            translations[i] = translation
+        # 重复的文本只请求一次
+        missing = list(dict.fromkeys(texts[i] for i in range(len(texts)) if i not in cached))
+        if missing:
+            results = dict(zip(missing, self.request_batch(missing)))
+            for i, text in enumerate(texts):
+                if i not in cached:
+                    translations[i] = results[text]
+            self.cache.put_many(key, self.from_l, self.to, missing, [results[_] for _ in missing])
+        return translations
+
+    def request_batch(self, texts):
+        """
+        一次请求翻译多段文本，失败后等待一段时间重试，重试次数用完后全部返回None，
+        不能用空字符串代替，否则调用方会把失败的段落当作翻译完成
+        :param texts: 文本列表
+        :return: 与texts一一对应的翻译列表
+        """
+        for attempt in range(TRANSLATE_MAX_RETRIES + 1):
+            self.rate_limiter.acquire()
+            incr('translate_api_calls')
+            incr('translate_api_bytes', sum(len(_.encode('utf-8')) for _ in texts))
+            try:
+                with span('Translate_Request', self.backend.category, texts=len(texts)):
+                    return self.backend.translate_batch(texts)
+            except Exception as e:
+                if attempt == TRANSLATE_MAX_RETRIES:
+                    logger.warning("Translation Error! %s", e)
+                    incr('translate_failures')
+                    return [None] * len(texts)
+                incr('translate_retries')
+                backoff = TRANSLATE_BACKOFF * 2 ** attempt
+                logger.debug("Translation Error! %s, %.1f秒后重试", e, backoff)
+                time.sleep(backoff)
+
+    def count_requests(self, texts):
+        """
+        :param texts: 文本列表
+        :return: 翻译这些文本需要的请求次数，不考虑缓存
+        """
+        return len(split_batches(texts, self.backend.batch_size, self.backend.batch_chars))
+
+    def translate_concurrently(self, texts, workers=TRANSLATE_WORKERS):
+        """
+        把文本打包后并发翻译，每完成一个包就返回一次结果
+        :param texts: 文本列表
+        :param workers: 同时进行的请求数量
+        :return: 生成器，每次返回 ([文本下标...], [翻译...])，请求失败的翻译为None
+        """
+        self.backend.load()
+        batches = split_batches(texts, self.backend.batch_size, self.backend.batch_chars)
+        if self.backend.max_workers:
+            workers = min(workers, self.backend.max_workers)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(self.translate_batch, [texts[_] for _ in batch]): batch for batch in batches}
+            for future in as_completed(futures):
+                yield futures[future], future.result()
 
 
 if __name__ == '__main__':
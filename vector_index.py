@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+from settings import *
+
+# 数据量小于该值时直接暴力搜索
+IVF_MIN_SIZE = 256
+# IVF 查询时搜索的聚类数量
+IVF_N_PROBE = 4
+# IVF 聚类迭代次数
+IVF_ITERATIONS = 10
+
+
+def build_index(vectors):
+    """
+    为一组归一化向量建立近似最近邻索引，安装了hnswlib时使用HNSW，否则使用纯NumPy的IVF索引
+    :param vectors: (n, d) 归一化向量矩阵，行号即为查询返回的id
+    :return: HnswIndex 或 IVFIndex
+    """
+    try:
+        import hnswlib
+    except ImportError:
+        return IVFIndex(vectors)
+    return HnswIndex(vectors)
+
+
+class HnswIndex:
+    """
+    基于hnswlib的内积索引
+    """
+
+    def __init__(self, vectors):
+        import hnswlib
+        vectors = np.asarray(vectors, dtype=np.float32)
+        self.size = len(vectors)
+        self.index = hnswlib.Index(space='ip', dim=vectors.shape[1])
+        self.index.init_index(max_elements=max(self.size, 1), ef_construction=200, M=16)
+        self.index.add_items(vectors, np.arange(self.size))
+
+    def query(self, vector, k):
+        """
+        :param vector: 归一化的查询向量
+        :param k: 返回数量
+        :return: (ids, scores) 按相似度从高到低排列
+        """
+        k = min(k, self.size)
+        if k == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        self.index.set_ef(max(k, 50))
+        labels, distances = self.index.knn_query(np.asarray(vector, dtype=np.float32), k=k)
+        # hnswlib 的内积距离为 1 - 内积
+        return labels[0], 1 - distances[0]
+
+
+class IVFIndex:
+    """
+    纯NumPy实现的倒排索引，先用球面k-means把向量分成若干簇，查询时只在最接近的几个簇里精确计算相似度
+    """
+
+    def __init__(self, vectors, n_probe=IVF_N_PROBE):
+        self.vectors = np.asarray(vectors, dtype=np.float32)
+        self.size = len(self.vectors)
+        self.n_probe = n_probe
+        if self.size < IVF_MIN_SIZE:
+            self.centroids = None
+            self.lists = [np.arange(self.size)]
+            return
+
+        n_lists = int(np.sqrt(self.size))
+        # 均匀取点作为初始中心，保证结果可复现
+        centroids = self.vectors[np.linspace(0, self.size - 1, n_lists).astype(int)]
+        for _ in range(IVF_ITERATIONS):
+            assign = np.argmax(self.vectors @ centroids.T, axis=1)
+            for c in range(n_lists):
+                members = self.vectors[assign == c]
+                if len(members) > 0:
+                    centroid = members.sum(axis=0)
+                    centroids[c] = centroid / max(np.linalg.norm(centroid), 1e-12)
+        self.centroids = centroids
+        assign = np.argmax(self.vectors @ centroids.T, axis=1)
+        self.lists = [np.flatnonzero(assign == c) for c in range(n_lists)]
+
+    def query(self, vector, k):
+        """
+        :param vector: 归一化的查询向量
+        :param k: 返回数量
+        :return: (ids, scores) 按相似度从高到低排列
+        """
+        if self.centroids is None:
+            candidates = self.lists[0]
+        else:
+            probe = np.argsort(-(self.centroids @ vector))[:self.n_probe]
+            candidates = np.concatenate([self.lists[_] for _ in probe])
+        scores = self.vectors[candidates] @ vector
+        order = np.argsort(-scores)[:k]
+        return candidates[order], scores[order]